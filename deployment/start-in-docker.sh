@@ -4,5 +4,14 @@ set -e
 
 export LC_ALL=C.UTF-8
 export LANG=C.UTF-8
-python3 server/main.py -d $SERIAL_DEVICE -b $BAUDRATE
 
+# Without SERIAL_DEVICE the devices come from config.yml, so a mounted config
+# with several serial_devices can be read by one container
+ARGS=()
+if [[ -n "$SERIAL_DEVICE" ]]; then
+  ARGS+=(-d "$SERIAL_DEVICE")
+fi
+if [[ -n "$BAUDRATE" ]]; then
+  ARGS+=(-b "$BAUDRATE")
+fi
+python3 server/main.py "${ARGS[@]}"
@@ -26,5 +26,14 @@ if [[ "$UPDATE" == "true" ]]; then
 fi
 
 echo "Starting visualizer. Open http://localhost:5000 to see the result."
+if [[ -n "$CONFIG" ]]; then
+  # Read the serial_devices of a config file, e.g.
+  # CONFIG=$PWD/config.yml DEVICES="/dev/ttyUSB0 /dev/ttyUSB1" ./start.sh
+  DEVICE_ARGS=()
+  for device in $DEVICES; do
+    DEVICE_ARGS+=(--device "$device")
+  done
+  exec docker run -it "${DEVICE_ARGS[@]}" -p 5000:5000 -v "$CONFIG:/srv/config.yml:ro" boxmein/kfst-boat-visualizer
+fi
 exec docker run -it --device ${1:-/dev/ttyUSB0} -p 5000:5000 -e "SERIAL_DEVICE=${1:-/dev/ttyUSB0}" -e "BAUDRATE=${2:-57600}" boxmein/kfst-boat-visualizer
 
@@ -1,13 +1,14 @@
 import React, {PureComponent} from 'react';
 import subscribe from './socket-listener';
-import {IMessage, ISerialMessage, IStatusMessage} from './interfaces';
+import {IMessage, ISerialMessage, ISnapshotMessage, IStatusMessage} from './interfaces';
 import logo from './Taltech.png';
 import { BoatCanvas } from "./BoatCanvas";
-import {scan, filter, map} from 'rxjs/operators';
+import {scan, filter} from 'rxjs/operators';
 
 import './App.css';
 
 const MAX_EVENTS = 100;
+const MAX_POINTS = 500;
 const zoom = 4;
 
 interface ILastLocation {
@@ -22,6 +23,9 @@ interface IAppState {
     log: IMessage[];
     offline: boolean;
     lastLocation?: ILastLocation;
+    /** The last location of every node, keyed by node id */
+    boats: { [node: string]: ILastLocation };
+    /** Track to draw, newest first: the snapshot received on connect followed by live positions, at most MAX_POINTS */
     points: ILastLocation[];
     status?: string | undefined;
     renderedRawData: React.ReactChild[];
@@ -35,12 +39,35 @@ function messageIsStatus(message: IMessage): message is IStatusMessage {
     return message && message.type === 'status';
 }
 
+function messageIsSnapshot(message: IMessage): message is ISnapshotMessage {
+    return message && message.type === 'snapshot';
+}
+
+/** Flattens the tracks of a snapshot into a list of locations, newest first. */
+function snapshotToLocations(message: ISnapshotMessage): ILastLocation[] {
+    const locations: ILastLocation[] = [];
+    for (const node of Object.keys(message.nodes)) {
+        const track = message.nodes[node];
+        for (let i = track.t.length - 1; i >= 0; i -= 1) {
+            locations.push({
+                x: track.x[i],
+                y: track.y[i],
+                phi: track.phi[i],
+                sp_x: track.sp_x[i],
+                sp_y: track.sp_y[i],
+            });
+        }
+    }
+    return locations;
+}
+
 
 class App extends PureComponent<{}, IAppState> {
     statusTimeout?: number | null;
     state: IAppState = {
         log: [],
         offline: false,
+        boats: {},
         points: [],
         status: undefined,
         renderedRawData: [],
@@ -79,12 +106,15 @@ class App extends PureComponent<{}, IAppState> {
         const obs = subscribe();
         this.resetOffline();
         const arrayObs = obs.pipe(
-            scan((acc: IMessage[], current: IMessage): IMessage[] => [current, ...acc.slice(-acc.length > MAX_EVENTS ? 1 : 0)], [] as IMessage[])
+            scan((acc: IMessage[], current: IMessage): IMessage[] => [current, ...acc.slice(0, MAX_EVENTS - 1)], [] as IMessage[])
         );
 
-        const positionMessages$ = arrayObs.pipe(
-            map((messages: IMessage[]): ISerialMessage[] => messages.filter(message => messageIsSerial(message) && message.msg === 1) as ISerialMessage[]),
-            map((messages: ISerialMessage[]): ILastLocation[] => messages.map(message => message.parsed as ILastLocation))
+        // A snapshot replaces the track, every position message is added in front of it
+        const track$ = obs.pipe(
+            filter((message: IMessage) => messageIsSnapshot(message) || (messageIsSerial(message) && message.msg === 1)),
+            scan((acc: ILastLocation[], message: IMessage): ILastLocation[] => messageIsSnapshot(message)
+                ? snapshotToLocations(message).slice(0, MAX_POINTS)
+                : [(message as ISerialMessage).parsed as ILastLocation, ...acc.slice(0, MAX_POINTS - 1)], [] as ILastLocation[])
         );
 
         obs.subscribe((message: IMessage) => {
@@ -98,7 +128,8 @@ class App extends PureComponent<{}, IAppState> {
                 return;
             }
             const lastLocation = message.parsed as ILastLocation;
-            this.setState({ lastLocation });
+            const node = String(message.node != null ? message.node : 0);
+            this.setState({ lastLocation, boats: { ...this.state.boats, [node]: lastLocation } });
             console.log('[App] Location update:', lastLocation);
         });
         obs.subscribe((message: IMessage) => {
@@ -115,7 +146,7 @@ class App extends PureComponent<{}, IAppState> {
             this.setState({ log: eventLog });
         });
 
-        positionMessages$.subscribe((points) => {
+        track$.subscribe((points) => {
             this.setState({ points });
         });
     }
@@ -187,7 +218,7 @@ class App extends PureComponent<{}, IAppState> {
                                 </div>
                                 <div> phi:{last ? last.phi.toFixed(1) : ''}</div>
                             </div>
-                            <BoatCanvas points={this.state.points} lastLocation={this.state.lastLocation} />
+                            <BoatCanvas points={this.state.points} lastLocation={this.state.lastLocation} boats={this.state.boats} />
                         </div>
 
 
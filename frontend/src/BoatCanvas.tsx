@@ -19,6 +19,10 @@ interface IBoatCanvasProps {
         x: number;
         y: number;
     };
+    /** The last location of every boat, keyed by node id */
+    boats?: {
+        [node: string]: { x: number; y: number; phi: number };
+    };
     points?: {
         x: number;
         y: number;
@@ -40,8 +44,10 @@ export class BoatCanvas extends PureComponent<IBoatCanvasProps> {
     scene: THREE.Scene | null = null;
     /** Holds the point cloud */
     points: THREE.Points | null = null;
-    /** Holds the boat */
-    boat: THREE.Object3D | null = null;
+    /** Holds the loaded boat model, cloned for every boat after the first */
+    boatModel: THREE.Object3D | null = null;
+    /** Holds one boat object per node */
+    boats: { [node: string]: THREE.Object3D } = {};
     /** Holds the desired location */
     desiredLocation: THREE.Object3D | null = null;
 
@@ -129,12 +135,21 @@ export class BoatCanvas extends PureComponent<IBoatCanvasProps> {
         // this.controls.update();
     }
 
-    updateBoat(lastPosition: { x: number, y: number, phi: number }): void {
-        if (!this.boat) {
+    updateBoats(boats: { [node: string]: { x: number, y: number, phi: number } }): void {
+        if (!this.boatModel || !this.scene) {
             return;
         }
-        this.boat.position.set(lastPosition.x, 0, lastPosition.y);
-        this.boat.rotation.set(0,  (Math.PI / 2.) - this.deg2rad(lastPosition.phi), 0);
+        for (const node of Object.keys(boats)) {
+            let boat = this.boats[node];
+            if (!boat) {
+                boat = Object.keys(this.boats).length === 0 ? this.boatModel : this.boatModel.clone();
+                this.boats[node] = boat;
+                this.scene.add(boat);
+            }
+            const location = boats[node];
+            boat.position.set(location.x, 0, location.y);
+            boat.rotation.set(0,  (Math.PI / 2.) - this.deg2rad(location.phi), 0);
+        }
     }
     
     updateDesiredLocation(x: number, y: number): void {
@@ -205,8 +220,8 @@ export class BoatCanvas extends PureComponent<IBoatCanvasProps> {
             console.log('Boat loaded', gltf);
             if (typeof this === 'object' && this.scene) {
                 gltf.scene.scale.set(0.01, 0.01, 0.01);
-                this.boat = gltf.scene;
-                this.scene.add(this.boat);
+                this.boatModel = gltf.scene;
+                this.updateBoats(this.props.boats || {});
             }
         }, undefined, (error) => {
             console.error(error);
@@ -286,10 +301,13 @@ export class BoatCanvas extends PureComponent<IBoatCanvasProps> {
             this.updatePoints(lastLocation, this.props.points);
         }
 
+        if (this.props.boats && this.props.boats !== prevProps.boats) {
+            this.updateBoats(this.props.boats);
+        }
+
         // If the last location has changed, update the point cloud to match
         if (this.props.lastLocation && this.props.lastLocation !== prevProps.lastLocation) {
             this.updateCamera(this.props.lastLocation);
-            this.updateBoat(this.props.lastLocation);
 
             this.updateDesiredLine(this.props.lastLocation);
 
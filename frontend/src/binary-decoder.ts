@@ -0,0 +1,79 @@
+import { ISerialMessage } from './interfaces';
+
+/**
+ * Decoder for the binary `messages_bin` batches sent by the server (see server/wire.py).
+ *
+ * A batch is a sequence of records, each made of a 10-byte little-endian header
+ * (_id: uint32, source: uint8, node: uint8, msg: uint8, flags: uint8, length: uint16)
+ * followed by the raw frame.
+ */
+const HEADER_SIZE = 10;
+const FLAG_VALID = 0x01;
+const NO_NODE = 0xff;
+
+function toHex(bytes: Uint8Array): string {
+    let hex = '';
+    for (let i = 0; i < bytes.length; i += 1) {
+        hex += (bytes[i] < 0x10 ? '0' : '') + bytes[i].toString(16);
+    }
+    return hex;
+}
+
+/**
+ * Decodes the fields of a raw frame, mirroring MESSAGE_FORMATS in server/packet_parser.py.
+ * Field offsets skip the 0xAA header and the message type byte.
+ */
+function decodeFields(msg: number, view: DataView, start: number, length: number): object {
+    if (msg === 1 && length === 24) {
+        return {
+            x: view.getFloat32(start + 2, true),
+            y: view.getFloat32(start + 6, true),
+            phi: view.getFloat32(start + 10, true),
+            sp_x: view.getFloat32(start + 14, true),
+            sp_y: view.getFloat32(start + 18, true),
+        };
+    }
+    if (msg === 2 && length === 5) {
+        return { node_id: view.getUint8(start + 2) };
+    }
+    if (msg === 3 && length === 10) {
+        return {
+            node_id: view.getUint8(start + 2),
+            type: view.getUint8(start + 3),
+            u: view.getFloat32(start + 4, true),
+        };
+    }
+    return {};
+}
+
+export function decodeBinaryBatch(data: ArrayBuffer | ArrayBufferView): ISerialMessage[] {
+    const view = ArrayBuffer.isView(data)
+        ? new DataView(data.buffer, data.byteOffset, data.byteLength)
+        : new DataView(data);
+    const bytes = new Uint8Array(view.buffer, view.byteOffset, view.byteLength);
+    const messages: ISerialMessage[] = [];
+
+    let offset = 0;
+    while (offset + HEADER_SIZE <= view.byteLength) {
+        const node = view.getUint8(offset + 5);
+        const msg = view.getUint8(offset + 6);
+        const length = view.getUint16(offset + 8, true);
+        const start = offset + HEADER_SIZE;
+        if (start + length > view.byteLength) {
+            break;
+        }
+        messages.push({
+            _id: view.getUint32(offset, true),
+            type: 'serial',
+            msg,
+            source: view.getUint8(offset + 4),
+            node: node === NO_NODE ? null : node,
+            raw_data: toHex(bytes.subarray(start, start + length)),
+            parsed: decodeFields(msg, view, start, length),
+            valid: (view.getUint8(offset + 7) & FLAG_VALID) !== 0,
+        });
+        offset = start + length;
+    }
+
+    return messages;
+}
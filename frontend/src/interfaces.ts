@@ -7,6 +7,8 @@ export interface ISerialMessage {
     _id: number;
     type: 'serial';
     msg: number;
+    source?: number;
+    node?: number | null;
     raw_data: string;
     parsed: object;
     valid: boolean;
@@ -19,4 +21,32 @@ export interface IStatusMessage {
     details?: string;
 }
 
-export type IMessage = IPingMessage | ISerialMessage | IStatusMessage;
+/** Columns of a node's recorded track, oldest first. */
+export interface ITrajectory {
+    t: number[];
+    x: number[];
+    y: number[];
+    phi: number[];
+    sp_x: number[];
+    sp_y: number[];
+}
+
+/** Sent by the server on connect with the downsampled track of every node so far. */
+export interface ISnapshotMessage {
+    _id: number;
+    type: 'snapshot';
+    nodes: { [node: string]: ITrajectory };
+}
+
+/**
+ * Derived state of the nodes that changed, sent by the server a few times per second.
+ * Every node maps to a list of values in the order of `columns`, e.g. heading, speed and turn_rate.
+ */
+export interface IKinematicsMessage {
+    _id: number;
+    type: 'kinematics';
+    columns: string[];
+    nodes: { [node: string]: number[] };
+}
+
+export type IMessage = IPingMessage | ISerialMessage | IStatusMessage | ISnapshotMessage | IKinematicsMessage;
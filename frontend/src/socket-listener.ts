@@ -1,24 +1,107 @@
 import socketIOClient from 'socket.io-client';
-import { Observable } from 'rxjs';
+import { Observable, Subject } from 'rxjs';
 import { IMessage } from './interfaces';
+import { decodeBinaryBatch } from './binary-decoder';
 const ENDPOINT = window.location.host;
 
+/**
+ * Builds the subscription sent to the server from the page URL.
+ *
+ * - ?wire=json falls back to JSON messages instead of the smaller binary format
+ * - ?types=1,2 and ?nodes=1 only receive those message types and nodes
+ * - ?mode=latest&rate=5 receives at most 5 state updates per second, always the newest
+ */
+function subscriptionFromUrl(): object {
+    const params = new URLSearchParams(window.location.search);
+    const list = (name: string) => (params.get(name) || '').split(',').filter(v => v !== '').map(Number);
+    const subscription: { [key: string]: any } = {
+        format: params.get('wire') === 'json' ? 'json' : 'binary',
+    };
+    if (params.get('types')) {
+        subscription.types = list('types');
+    }
+    if (params.get('nodes')) {
+        subscription.nodes = list('nodes');
+    }
+    if (params.get('mode') === 'latest') {
+        subscription.mode = 'latest';
+        subscription.rate = Number(params.get('rate') || 10);
+    }
+    return subscription;
+}
+
 function validateMessage(msg: any): msg is IMessage {
     return typeof msg === 'object' &&
            typeof msg._id === 'number' &&
            typeof msg.type === 'string';
 }
 
+/** How often the newest drawn serial message is acknowledged, for latency measurement */
+const ACK_INTERVAL = 1000;
+
 export default function subscribe(): Observable<IMessage> {
     const sock = socketIOClient(ENDPOINT);
-    const obs = new Observable<IMessage>((subject) => {
-        sock.on('message', (message: object) => {
-            // console.log('socket-listener', message);
+    // Subscribe again on every (re)connect
+    const subscription = subscriptionFromUrl();
+    sock.on('connect', () => {
+        sock.emit('subscribe', subscription);
+    });
+    // Acknowledge the newest serial message once it has been drawn, at most once per ACK_INTERVAL
+    let lastAck = 0;
+    const ack = (id: number) => {
+        const now = Date.now();
+        if (now - lastAck < ACK_INTERVAL) {
+            return;
+        }
+        lastAck = now;
+        window.requestAnimationFrame(() => sock.emit('ack', id));
+    };
+
+    // The handlers are registered once and shared by every subscriber, so each batch is decoded once
+    const subject = new Subject<IMessage>();
+    sock.on('snapshot', (message: object) => {
+        if (validateMessage(message)) {
+            subject.next(message);
+        }
+    });
+    sock.on('kinematics', (message: object) => {
+        if (validateMessage(message)) {
+            subject.next(message);
+        }
+    });
+    sock.on('message', (message: object) => {
+        // console.log('socket-listener', message);
+        if (validateMessage(message)) {
+            subject.next(message);
+        }
+    });
+    // The server sends serial messages in batches, oldest first
+    sock.on('messages', (messages: object[]) => {
+        if (!Array.isArray(messages)) {
+            return;
+        }
+        let newestSerial: number | null = null;
+        for (const message of messages) {
             if (validateMessage(message)) {
                 subject.next(message);
+                if (message.type === 'serial') {
+                    newestSerial = message._id;
+                }
             }
-        });
+        }
+        if (newestSerial !== null) {
+            ack(newestSerial);
+        }
+    });
+    sock.on('messages_bin', (data: ArrayBuffer) => {
+        const messages = decodeBinaryBatch(data);
+        for (const message of messages) {
+            subject.next(message);
+        }
+        if (messages.length > 0) {
+            ack(messages[messages.length - 1]._id);
+        }
     });
 
-    return obs;
+    return subject.asObservable();
 }
\ No newline at end of file
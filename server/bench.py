@@ -0,0 +1,183 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from struct import unpack
+from binascii import crc_hqx
+
+from synthetic import generate_stream
+from serial_reader import Framer, process_new_data
+from packet_parser import parse_many, validate_crc
+from crc import validate_many
+
+#
+# Benchmarks for the serial ingest pipeline.
+#
+# Every stage runs over the same synthetic stream. Results are printed as JSON so
+# runs on different commits or hosts can be compared:
+#
+#   python3 server/bench.py --frames 100000 --garbage 0.05 --crc-errors 0.01 > bench.json
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--frames", help="Number of frames in the synthetic stream", type=int, default=50000)
+parser.add_argument("--chunk", help="Bytes per read handed to the framer", type=int, default=128)
+parser.add_argument("--mix", help="Share of each message type, e.g. 1=0.7,2=0.15,3=0.1,4=0.05", type=str)
+parser.add_argument("--boats", help="Number of simulated boats", type=int, default=1)
+parser.add_argument("--garbage", help="Chance of garbage bytes after a frame", type=float, default=0.01)
+parser.add_argument("--truncated", help="Chance of a frame being cut short", type=float, default=0.005)
+parser.add_argument("--crc-errors", help="Chance of a corrupted frame", type=float, default=0.01)
+parser.add_argument("--repeat", help="Runs per stage, the fastest is reported", type=int, default=3)
+parser.add_argument("--seed", help="Random seed for the stream", type=int, default=1)
+parser.add_argument("-o", "--output", help="Write the JSON results to this file instead of stdout", type=str)
+
+def parse_mix(text):
+  if not text:
+    return None
+  mix = {}
+  for part in text.split(','):
+    key, value = part.split('=')
+    mix[int(key, 0)] = float(value)
+  return mix
+
+#
+# The parser as it was before the table of precompiled structs, as a baseline for the
+# `parser` stage: one unpack per message type into a dict, and the CRC over a copy of
+# the frame (computed with crc_hqx here, the original used the crc16 module).
+LEGACY_FORMATS = {
+  0x01: ('<ccfffffcc', 24, ('x', 'y', 'phi', 'sp_x', 'sp_y')),
+  0x02: ('<ccccc', 5, ('node_id',)),
+  0x03: ('<ccccfcc', 10, ('node_id', 'type', 'u')),
+}
+
+def legacy_parse(frame):
+  if len(frame) < 2 or frame[0] != 0xAA:
+    return None
+  message_type = frame[1]
+  if message_type == 0x04:
+    return message_type, {}, crc_hqx(bytes(frame[:-2]), 0) == ((frame[-2] << 8) | frame[-1])
+  fmt = LEGACY_FORMATS.get(message_type)
+  if fmt is None or len(frame) != fmt[1]:
+    return None
+  unpacked = unpack(fmt[0], frame)
+  values = [int.from_bytes(v, 'little') if isinstance(v, bytes) else v for v in unpacked[2:-2]]
+  crc = ((int.from_bytes(unpacked[-2], 'little') & 0xff) << 8) | (int.from_bytes(unpacked[-1], 'little') & 0xff)
+  return message_type, dict(zip(fmt[2], values)), crc_hqx(bytes(frame[:-2]), 0) == crc
+
+def chunks(data, size):
+  return [data[i:i + size] for i in range(0, len(data), size)]
+
+#
+# Runs `fn` `repeat` times and reports the fastest run, then once more under
+# tracemalloc for the peak memory and the number of blocks it left allocated.
+def measure(fn, repeat, frames, nbytes):
+  best = None
+  for _ in range(repeat):
+    started = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - started
+    best = elapsed if best is None else min(best, elapsed)
+
+  blocks_before = sys.getallocatedblocks()
+  tracemalloc.start()
+  fn()
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  blocks_after = sys.getallocatedblocks()
+
+  return {
+    'seconds': best,
+    'frames_per_sec': frames / best if best else None,
+    'bytes_per_sec': nbytes / best if best else None,
+    'peak_memory_bytes': peak,
+    'retained_blocks': blocks_after - blocks_before,
+  }
+
+def run(args):
+  stream, stats = generate_stream(args.frames, parse_mix(args.mix), args.boats, args.garbage,
+                                  args.truncated, args.crc_errors, seed=args.seed)
+  reads = chunks(stream, args.chunk)
+  frames = Framer().feed(stream)
+  packets = parse_many(frames)
+  with_crc = [(frame, (frame[-2] << 8) | frame[-1]) for frame in frames if len(frame) >= 2]
+
+  def framer():
+    f = Framer()
+    for data in reads:
+      f.feed(data)
+
+  # Both parser stages hand every packet to a sink, as the serial reader does
+  def parser_baseline():
+    sink = []
+    for frame in frames:
+      packet = legacy_parse(frame)
+      if packet is not None:
+        sink.append(packet)
+
+  def parser():
+    sink = []
+    for packet in parse_many(frames):
+      sink.append((packet.message_type, packet.values, packet.valid))
+
+  def crc():
+    for frame, expected in with_crc:
+      validate_crc(frame, expected)
+
+  # Same-length frames, as replay and offline analysis validate them
+  state_frames = [frame for frame in frames if len(frame) == 24]
+
+  def crc_batch():
+    validate_many(state_frames)
+
+  def end_to_end():
+    f = Framer()
+    emitted = []
+    sink = lambda *packet: emitted.append(packet)
+    for data in reads:
+      process_new_data(f, data, sink)
+
+  frame_bytes = sum(len(frame) for frame in frames)
+  stages = {
+    'framer': (framer, len(frames), len(stream)),
+    'parser_baseline': (parser_baseline, len(frames), frame_bytes),
+    'parser': (parser, len(frames), frame_bytes),
+    'crc': (crc, len(frames), frame_bytes),
+    'crc_batch': (crc_batch, len(state_frames), 24 * len(state_frames)),
+    'end_to_end': (end_to_end, len(frames), len(stream)),
+  }
+  results = {name: measure(fn, args.repeat, count, nbytes) for name, (fn, count, nbytes) in stages.items()}
+
+  results['parser']['speedup_over_baseline'] = results['parser_baseline']['seconds'] / results['parser']['seconds']
+
+  # 8N1 serial framing sends 10 bits per byte
+  max_baud = results['end_to_end']['bytes_per_sec'] * 10
+
+  return {
+    'timestamp': time.time(),
+    'host': {
+      'machine': platform.machine(),
+      'processor': platform.processor(),
+      'python': platform.python_version(),
+      'implementation': platform.python_implementation(),
+    },
+    'stream': {
+      'bytes': len(stream),
+      'frames_found': len(frames),
+      'packets_decoded': len(packets),
+      'packets_valid': sum(1 for packet in packets if packet.valid),
+      'chunk': args.chunk,
+      'generated': stats.as_dict(),
+    },
+    'stages': results,
+    'max_sustainable_baud': max_baud,
+  }
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  results = json.dumps(run(args), indent=2)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(results + '\n')
+  else:
+    print(results)
@@ -0,0 +1,307 @@
+import os
+import re
+import json
+import mmap
+import time
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+from serial_reader import Framer
+from packet_parser import MESSAGE_FORMATS, get_message_length, get_length_offset
+from crc import validate_frame, validate_many
+from recorder import SEGMENT_MAGIC, RECORD_HEADER, load_index
+
+#
+# Converts raw serial captures and recorder segments into one columnar .npy file per message type.
+#
+# A raw capture is split into chunks that start at a 0xAA followed by a frame with a
+# good CRC, so no frame is cut in two. A segment is split at the record offsets in its
+# index. Chunks are framed and decoded in a pool of worker processes, reading the file
+# through mmap, and the results are appended to the output files in capture order.
+# Memory use depends on the chunk size and the number of workers, not on the size of the capture:
+#
+#   python3 server/convert.py capture.bin -o capture/ --jobs 4
+#   python3 server/convert.py recordings/20190527-101500.seg -o capture/
+#
+# Every output file is a structured array with the columns
+#   offset: byte offset of the frame (of the record for segments) in the file
+#   line_time (raw captures): seconds from the start of the capture if the line was never idle,
+#     at the baud rate, plus --start. Only an estimate: real captures have idle gaps.
+#   timestamp, source (segments): receive time and source id of the frame as recorded
+#   valid: the CRC matched
+#   length: frame length in bytes
+# followed by the decoded fields of the message type, e.g. x, y, phi, sp_x, sp_y for state.
+# Frames of unknown types are counted but not written.
+#
+#   state = np.load('capture/state.npy', mmap_mode='r')
+#   state[state['valid']]['x']
+
+parser = argparse.ArgumentParser()
+parser.add_argument("capture", help="Raw serial capture or recorder segment (.seg)", type=str)
+parser.add_argument("-o", "--output", help="Directory to write the .npy files into", type=str, required=True)
+parser.add_argument("-j", "--jobs", help="Worker processes, defaults to the number of CPUs", type=int)
+parser.add_argument("--chunk-mb", help="Size of the chunks handed to the workers", type=float, default=8)
+parser.add_argument("-b", "--baudrate", help="Baud rate a raw capture was taken at, used for line_time", type=int, default=57600)
+parser.add_argument("--start", help="UNIX time a raw capture started at, added to line_time", type=float, default=0)
+
+RAW_COLUMNS = [('offset', '<u8'), ('line_time', '<f8'), ('valid', '?'), ('length', '<u2')]
+SEGMENT_COLUMNS = [('offset', '<u8'), ('timestamp', '<f8'), ('source', 'u1'), ('valid', '?'), ('length', '<u2')]
+
+# How far past a nominal chunk boundary to look for a frame to start the next chunk at
+BOUNDARY_SEARCH = 64 * 1024
+
+#
+# The layout of a whole frame of `fmt` as a NumPy dtype, built from its payload struct.
+# Returns None for message types without a fixed length or payload.
+def frame_dtype(fmt):
+  if fmt.length is None or fmt.payload is None:
+    return None
+  names = []
+  formats = []
+  offsets = []
+  offset = 0
+  for count, code in re.findall(r'(\d*)([a-zA-Z?])', fmt.payload.format.lstrip('<>=!@')):
+    count = int(count or 1)
+    if code == 'x':
+      offset += count
+      continue
+    size = np.dtype(code).itemsize
+    for _ in range(count):
+      names.append(fmt.fields[len(names)])
+      formats.append(np.dtype(code).newbyteorder('<'))
+      offsets.append(offset)
+      offset += size
+  return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': fmt.length})
+
+#
+# The dtype of the output file of `fmt`, with the `common` columns first
+def output_dtype(fmt, common):
+  layout = frame_dtype(fmt)
+  fields = [] if layout is None else [(name, layout.fields[name][0]) for name in layout.names]
+  return np.dtype(common + fields)
+
+def is_segment(path):
+  with open(path, 'rb') as f:
+    return f.read(len(SEGMENT_MAGIC)) == SEGMENT_MAGIC
+
+# Whether a good frame starts at `pos`
+def frame_at(data, pos):
+  if pos + 2 > len(data) or data[pos] != 0xAA:
+    return False
+  message_type = data[pos + 1]
+  length = get_message_length(message_type)
+  if length is None:
+    length_offset = get_length_offset(message_type)
+    if length_offset is None or pos + length_offset >= len(data):
+      return False
+    length = length_offset + data[pos + length_offset] + 2
+  return pos + length <= len(data) and validate_frame(data[pos:pos + length])
+
+#
+# Returns the offset of the first good frame at or after `pos`, the next 0xAA if
+# there is none close by, or the end of the data.
+def find_boundary(data, pos):
+  limit = min(len(data), pos + BOUNDARY_SEARCH)
+  candidate = data.find(b'\xaa', pos, limit)
+  first = candidate
+  while candidate != -1:
+    if frame_at(data, candidate):
+      return candidate
+    candidate = data.find(b'\xaa', candidate + 1, limit)
+  if first != -1:
+    return first
+  return limit
+
+#
+# Splits the capture into (start, end) byte ranges of about `chunk_size` bytes.
+def split_capture(path, chunk_size):
+  with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+    size = len(data)
+    chunks = []
+    start = 0
+    while start < size:
+      end = size if start + chunk_size >= size else find_boundary(data, start + chunk_size)
+      chunks.append((start, end))
+      start = end
+  return chunks
+
+#
+# Splits a recorder segment into (start, end) byte ranges of about `chunk_size` bytes,
+# at the record offsets in its index.
+def split_segment(path, chunk_size):
+  size = os.path.getsize(path)
+  chunks = []
+  start = len(SEGMENT_MAGIC)
+  for offset in load_index(path + '.idx')[1]:
+    if offset - start >= chunk_size and offset < size:
+      chunks.append((start, offset))
+      start = offset
+  chunks.append((start, size))
+  return chunks
+
+#
+# Groups frames by message type and decodes them into structured arrays with the `common` columns.
+# `columns` maps the other common column names to NumPy arrays of a value per frame.
+# Returns a dict of message type to a structured array and the count of frames of unknown types.
+def decode_frames(frames, common, columns):
+  by_type = {}
+  unknown = 0
+  for i, frame in enumerate(frames):
+    if len(frame) < 2:
+      unknown += 1
+      continue
+    by_type.setdefault(frame[1], []).append(i)
+
+  result = {}
+  for message_type, indices in by_type.items():
+    fmt = MESSAGE_FORMATS.get(message_type)
+    if fmt is None:
+      unknown += len(indices)
+      continue
+
+    typed_frames = [frames[i] for i in indices]
+    output = np.zeros(len(indices), dtype=output_dtype(fmt, common))
+    for name, values in columns.items():
+      output[name] = values[indices]
+
+    layout = frame_dtype(fmt)
+    if layout is not None:
+      output['length'] = [len(frame) for frame in typed_frames]
+      # The framer always cuts these at their length, but a damaged segment might not
+      if (output['length'] != fmt.length).any():
+        typed_frames = [frame[:fmt.length].ljust(fmt.length, b'\0') for frame in typed_frames]
+      rows = np.frombuffer(b''.join(typed_frames), dtype=np.uint8).reshape(len(typed_frames), fmt.length)
+      output['valid'] = validate_many(rows) & (output['length'] == fmt.length)
+      decoded = rows.reshape(-1).view(layout)
+      for name in layout.names:
+        output[name] = decoded[name]
+    else:
+      output['length'] = [len(frame) for frame in typed_frames]
+      output['valid'] = [validate_frame(frame) for frame in typed_frames]
+    result[message_type] = output
+
+  return result, unknown
+
+#
+# Frames and decodes the bytes in [start, end) of a raw capture.
+# Returns a dict of message type to a structured array, the count of frames of unknown types and the garbage bytes.
+def decode_chunk(path, start, end, baudrate, start_time):
+  with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+    framer = Framer()
+    offsets = []
+    frames = framer.feed(data[start:end], offsets)
+
+  offsets = np.array(offsets, dtype=np.uint64) + np.uint64(start)
+  # 8N1 serial framing sends 10 bits per byte
+  line_time = start_time + offsets * (10.0 / baudrate)
+  result, unknown = decode_frames(frames, RAW_COLUMNS, {'offset': offsets, 'line_time': line_time})
+  return result, unknown, framer.garbage
+
+#
+# Decodes the records in [start, end) of a recorder segment, which are already framed.
+# A record cut short at the end of the segment is ignored, like when replaying.
+def decode_segment_chunk(path, start, end):
+  frames = []
+  offsets = []
+  timestamps = []
+  sources = []
+  with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+    offset = start
+    while offset + RECORD_HEADER.size <= end:
+      timestamp, source, length = RECORD_HEADER.unpack_from(data, offset)
+      frame_start = offset + RECORD_HEADER.size
+      if frame_start + length > end:
+        break
+      frames.append(data[frame_start:frame_start + length])
+      offsets.append(offset)
+      timestamps.append(timestamp)
+      sources.append(source)
+      offset = frame_start + length
+
+  result, unknown = decode_frames(frames, SEGMENT_COLUMNS, {
+    'offset': np.array(offsets, dtype=np.uint64),
+    'timestamp': np.array(timestamps, dtype=np.float64),
+    'source': np.array(sources, dtype=np.uint8),
+  })
+  return result, unknown, 0
+
+#
+# Appends structured arrays to a .npy file whose length is only known at the end.
+# The header is written with room for any length and rewritten on close.
+class NpyWriter:
+  def __init__(self, path, dtype):
+    self.dtype = dtype
+    self.count = 0
+    self.header_size = len(self._header(10 ** 18))
+    self.file = open(path, 'wb')
+    self.file.write(self._header(0, self.header_size))
+
+  def _header(self, count, size=None):
+    text = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.lib.format.dtype_to_descr(self.dtype), count)
+    if size is None:
+      # magic, version and header length take 10 bytes and the data starts 64 byte aligned
+      size = -(-(10 + len(text) + 1) // 64) * 64
+    text = text.ljust(size - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + (size - 10).to_bytes(2, 'little') + text.encode('latin1')
+
+  def write(self, array):
+    self.file.write(array.tobytes())
+    self.count += len(array)
+
+  def close(self):
+    self.file.seek(0)
+    self.file.write(self._header(self.count, self.header_size))
+    self.file.close()
+
+def _decode(task):
+  function, args = task
+  return function(*args)
+
+def convert(args):
+  os.makedirs(args.output, exist_ok=True)
+  started = time.time()
+  chunk_size = int(args.chunk_mb * 1024 * 1024)
+  if is_segment(args.capture):
+    common = SEGMENT_COLUMNS
+    chunks = split_segment(args.capture, chunk_size)
+    tasks = [(decode_segment_chunk, (args.capture, start, end)) for start, end in chunks]
+  else:
+    common = RAW_COLUMNS
+    chunks = split_capture(args.capture, chunk_size)
+    tasks = [(decode_chunk, (args.capture, start, end, args.baudrate, args.start)) for start, end in chunks]
+
+  writers = {
+    message_type: NpyWriter(os.path.join(args.output, fmt.name + '.npy'), output_dtype(fmt, common))
+    for message_type, fmt in MESSAGE_FORMATS.items()
+  }
+  unknown = 0
+  garbage = 0
+  with Pool(args.jobs) as pool:
+    # imap keeps the chunks in capture order
+    for result, chunk_unknown, chunk_garbage in pool.imap(_decode, tasks):
+      for message_type, columns in result.items():
+        writers[message_type].write(columns)
+      unknown += chunk_unknown
+      garbage += chunk_garbage
+  for writer in writers.values():
+    writer.close()
+
+  elapsed = time.time() - started
+  size = os.path.getsize(args.capture)
+  return {
+    'capture': args.capture,
+    'segment': common is SEGMENT_COLUMNS,
+    'bytes': size,
+    'chunks': len(chunks),
+    'jobs': args.jobs or os.cpu_count(),
+    'seconds': elapsed,
+    'bytes_per_sec': size / elapsed if elapsed else None,
+    'frames': {MESSAGE_FORMATS[t].name: writer.count for t, writer in writers.items()},
+    'unknown_frames': unknown,
+    'garbage_bytes': garbage,
+  }
+
+if __name__ == '__main__':
+  print(json.dumps(convert(parser.parse_args()), indent=2))
@@ -0,0 +1,61 @@
+from binascii import crc_hqx
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+#
+# CRC16-XMODEM (polynomial 0x1021, initial value 0, not reflected), as sent in
+# the last two bytes of every frame, most significant byte first.
+#
+# Single frames are checked with binascii.crc_hqx, which computes the same CRC in C
+# and reads memoryview slices without copying them. Batches of same-length frames
+# are checked column by column with NumPy when it is installed.
+
+def _make_table():
+  table = []
+  for i in range(256):
+    crc = i << 8
+    for _ in range(8):
+      crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+    table.append(crc & 0xffff)
+  return tuple(table)
+
+CRC_TABLE = _make_table()
+CRC_TABLE_NP = np.array(CRC_TABLE, dtype=np.uint16) if np is not None else None
+
+def crc16xmodem(data, crc=0):
+  return crc_hqx(data, crc)
+
+# The CRC stored at the end of a frame
+def frame_crc(frame):
+  return (frame[-2] << 8) | frame[-1]
+
+#
+# Checks the CRC at the end of a frame against the CRC of the rest of it.
+def validate_frame(frame):
+  if len(frame) < 2:
+    return False
+  return crc_hqx(memoryview(frame)[:-2], 0) == frame_crc(frame)
+
+#
+# Checks many frames of the same length at once.
+# `frames` is a list of frames or a 2D uint8 array with one frame per row.
+# Returns a list of booleans, or a NumPy bool array when NumPy is available.
+def validate_many(frames):
+  if np is None:
+    return [validate_frame(frame) for frame in frames]
+
+  if isinstance(frames, np.ndarray):
+    rows = frames
+  else:
+    if len(frames) == 0:
+      return np.zeros(0, dtype=bool)
+    rows = np.frombuffer(b''.join(frames), dtype=np.uint8).reshape(len(frames), -1)
+
+  crc = np.zeros(rows.shape[0], dtype=np.uint16)
+  for column in range(rows.shape[1] - 2):
+    crc = (crc << 8) ^ CRC_TABLE_NP[(crc >> 8) ^ rows[:, column]]
+  expected = (rows[:, -2].astype(np.uint16) << 8) | rows[:, -1]
+  return crc == expected
@@ -0,0 +1,191 @@
+import os
+import time
+import select
+import logging
+from collections import deque
+from threading import Lock
+
+from wire import FORMAT_BINARY, to_json, encode_binary
+from subscriptions import MODE_LATEST
+import metrics
+
+log = logging.getLogger('emitter')
+
+BATCHES = metrics.counter('emitter_batches_total', 'Batches sent to the browsers')
+MESSAGES = metrics.counter('emitter_messages_total', 'Messages taken off the queue and sent to the browsers')
+EMIT_ERRORS = metrics.counter('emitter_errors_total', 'Batches that failed to send')
+LATENCY = metrics.histogram('serial_read_to_emit_seconds', 'Time from reading a frame off the serial device to sending it')
+ACK_LATENCY = metrics.histogram('serial_read_to_client_ack_seconds',
+                                'Time from reading a frame off the serial device to a browser acknowledging it was drawn')
+
+#
+# A bounded, thread-safe queue between the serial reader thread and the Socket.IO emitter.
+#
+# When the queue is full the oldest message is dropped and counted, so a stalled
+# emitter never grows memory without limit. Putting a message into an empty queue
+# writes a byte into a pipe, which lets the emitter sleep until there is data.
+class MessageQueue:
+  def __init__(self, maxsize=2000):
+    self.maxsize = maxsize
+    self.messages = deque()
+    self.dropped = 0
+    self.lock = Lock()
+    self.wake_fd, self.notify_fd = os.pipe()
+    os.set_blocking(self.wake_fd, False)
+    os.set_blocking(self.notify_fd, False)
+
+  def put(self, message):
+    with self.lock:
+      if not self.messages:
+        self._notify()
+      elif len(self.messages) >= self.maxsize:
+        self.messages.popleft()
+        self.dropped += 1
+      self.messages.append(message)
+
+  # Removes and returns up to max_items messages from the front of the queue
+  def drain(self, max_items):
+    with self.lock:
+      count = min(max_items, len(self.messages))
+      return [self.messages.popleft() for _ in range(count)]
+
+  def qsize(self):
+    return len(self.messages)
+
+  def _notify(self):
+    try:
+      os.write(self.notify_fd, b'\0')
+    except BlockingIOError:
+      # The pipe is full of wakeups already
+      pass
+
+  # Blocks the calling (green) thread until a message may be available
+  def wait(self, sio, timeout=1.0):
+    if sio.async_mode == 'eventlet':
+      from eventlet.hubs import trampoline
+      trampoline(self.wake_fd, read=True)
+    elif sio.async_mode == 'threading':
+      select.select([self.wake_fd], [], [], timeout)
+    else:
+      sio.sleep(timeout / 10)
+    self._clear()
+
+  def _clear(self):
+    try:
+      while os.read(self.wake_fd, 4096):
+        pass
+    except BlockingIOError:
+      pass
+
+#
+# Remembers when recently sent serial messages were read, so acknowledgements
+# from the browsers can be turned into end-to-end latencies.
+class SentTimes:
+  def __init__(self, size=10000):
+    self.size = size
+    self.times = {}
+    self.ids = deque()
+
+  def add(self, messages):
+    for message in messages:
+      if 't_rx' not in message:
+        continue
+      self.times[message['_id']] = message['t_rx']
+      self.ids.append(message['_id'])
+      if len(self.ids) > self.size:
+        self.times.pop(self.ids.popleft(), None)
+
+  # Records the latency of a message a browser has drawn
+  def ack(self, message_id):
+    t_rx = self.times.get(message_id)
+    if t_rx is None:
+      return None
+    latency = time.time() - t_rx
+    ACK_LATENCY.observe(latency)
+    return latency
+
+#
+# Sends messages to a room in the given wire format.
+# JSON clients get a `messages` event. Binary clients get serial messages as one
+# binary `messages_bin` event and any other messages as a `messages` event.
+def emit_encoded(sio, messages, fmt, room):
+  if fmt != FORMAT_BINARY:
+    sio.emit('messages', [to_json(message) for message in messages], room=room)
+    return
+
+  serial = [message for message in messages if message['type'] == 'serial']
+  other = [message for message in messages if message['type'] != 'serial']
+  if serial:
+    sio.emit('messages_bin', encode_binary(serial), room=room)
+  if other:
+    sio.emit('messages', other, room=room)
+
+#
+# Sends one batch to every subscription room, filtered by what the room subscribed to.
+# State messages for conflating rooms are left to conflate_latest.
+def send_batch(sio, batch, subscriptions, conflator):
+  conflator.update(batch)
+  BATCHES.inc()
+  MESSAGES.inc(len(batch))
+  for subscription in subscriptions.active():
+    selected = [message for message in batch
+                if subscription.matches(message) and not subscription.conflates(message)]
+    if selected:
+      emit_encoded(sio, selected, subscription.format, subscription.room)
+
+#
+# A green thread that sends the newest state of every node to conflating rooms,
+# at most `subscription.rate` times per second per room.
+def conflate_latest(sio, subscriptions, conflator, tick=0.02):
+  sent_version = {}
+  next_due = {}
+  while True:
+    now = time.time()
+    rooms = set()
+    for subscription in subscriptions.active():
+      if subscription.mode != MODE_LATEST:
+        continue
+      room = subscription.room
+      rooms.add(room)
+      if now < next_due.get(room, 0):
+        continue
+      messages = conflator.since(sent_version.get(room, 0), subscription)
+      sent_version[room] = conflator.version
+      if messages:
+        emit_encoded(sio, messages, subscription.format, room)
+        next_due[room] = now + 1.0 / subscription.rate
+
+    # Forget rooms that have no clients left
+    for room in list(sent_version):
+      if room not in rooms:
+        sent_version.pop(room, None)
+        next_due.pop(room, None)
+    sio.sleep(tick)
+
+#
+# A green thread that sends queued messages to the browser in batches.
+#
+# It sleeps until the reader thread queues something, then drains up to
+# batch_size messages and emits them as one `messages` event. Batches are sent
+# at most once per flush_interval, so under load messages are coalesced and
+# when the link is quiet a new message goes out immediately.
+def emit_batches(sio, q, subscriptions, conflator, sent_times, flush_interval=0.05, batch_size=200):
+  log.info("starting serial-emitter-thread")
+  while True:
+    batch = q.drain(batch_size)
+    if not batch:
+      q.wait(sio)
+      continue
+
+    try:
+      send_batch(sio, batch, subscriptions, conflator)
+    except Exception:
+      EMIT_ERRORS.inc()
+      log.exception("failed to emit batch")
+
+    now = time.time()
+    for message in batch:
+      if 't_rx' in message:
+        LATENCY.observe(now - message['t_rx'])
+    sent_times.add(batch)
+    sio.sleep(flush_interval)
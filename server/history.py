@@ -0,0 +1,173 @@
+import time
+from array import array
+from threading import Lock
+
+from packet_parser import MESSAGE_FORMATS
+
+#
+# Bounded history of decoded 0x01 state per node.
+#
+# 0x01 messages carry no node id. A state message is attributed to the node named
+# in the latest 0x02 state request from the same source, which is what the base
+# station polls with. Node ids are expected to be unique across sources.
+STATE_COLUMNS = MESSAGE_FORMATS[0x01].fields
+# Position of node_id in the decoded values, by message type
+NODE_ID_INDEX = {t: fmt.fields.index('node_id') for t, fmt in MESSAGE_FORMATS.items() if 'node_id' in fmt.fields}
+
+#
+# A ring buffer of state samples, stored column-wise in preallocated arrays.
+class NodeHistory:
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.t = array('d', bytes(8 * capacity))
+    self.columns = [array('f', bytes(4 * capacity)) for _ in STATE_COLUMNS]
+    self.start = 0
+    self.count = 0
+
+  def append(self, timestamp, values):
+    if self.count < self.capacity:
+      i = (self.start + self.count) % self.capacity
+      self.count += 1
+    else:
+      i = self.start
+      self.start = (self.start + 1) % self.capacity
+
+    self.t[i] = timestamp
+    for column, value in zip(self.columns, values):
+      column[i] = value
+
+  # Physical position of the n-th oldest sample
+  def _slot(self, n):
+    return (self.start + n) % self.capacity
+
+  # Number of samples older than `timestamp`
+  def _bisect(self, timestamp):
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.t[self._slot(mid)] < timestamp:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  #
+  # Returns the samples with start <= t <= end, oldest first, as a dict of arrays.
+  # Copies with at most two slices per column, so it is quick to call with the lock held.
+  def range(self, start=None, end=None):
+    first = 0 if start is None else self._bisect(start)
+    last = self.count if end is None else self._bisect(end + 1e-9)
+    result = {'t': self._copy(self.t, first, last)}
+    for name, column in zip(STATE_COLUMNS, self.columns):
+      result[name] = self._copy(column, first, last)
+    return result
+
+  # The `first` to `last` oldest values of a column
+  def _copy(self, column, first, last):
+    begin = self._slot(first)
+    end = begin + last - first
+    if end <= self.capacity:
+      return column[begin:end]
+    return column[begin:] + column[:end - self.capacity]
+
+#
+# Largest-Triangle-Three-Buckets downsampling of a track.
+# Returns the indices of at most `threshold` points that keep the shape of the (x, y) path,
+# always including the first and the last point.
+def lttb(xs, ys, threshold):
+  n = len(xs)
+  if threshold >= n:
+    return list(range(n))
+  if threshold < 3:
+    return [0, n - 1][:max(threshold, 0)]
+
+  indices = [0]
+  bucket_size = (n - 2) / (threshold - 2)
+  a = 0
+  for i in range(threshold - 2):
+    # The average of the next bucket is the third corner of the triangle
+    next_start = int((i + 1) * bucket_size) + 1
+    next_end = min(int((i + 2) * bucket_size) + 1, n)
+    count = next_end - next_start
+    avg_x = sum(xs[next_start:next_end]) / count
+    avg_y = sum(ys[next_start:next_end]) / count
+
+    # Pick the point of this bucket that forms the largest triangle
+    start = int(i * bucket_size) + 1
+    end = int((i + 1) * bucket_size) + 1
+    ax, ay = xs[a], ys[a]
+    best = start
+    best_area = -1.0
+    for j in range(start, end):
+      area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+      if area > best_area:
+        best_area = area
+        best = j
+    indices.append(best)
+    a = best
+
+  indices.append(n - 1)
+  return indices
+
+class StateHistory:
+  def __init__(self, capacity=36000):
+    self.capacity = capacity
+    self.nodes = {}
+    # The node of the latest state request, per source
+    self.current_nodes = {}
+    self.lock = Lock()
+    # (time, points, snapshot) of the latest snapshot
+    self.snapshot_cache = None
+
+  #
+  # Records a decoded packet, given as its values in field order, and returns the node it belongs to, if known.
+  # Called from the serial reader thread.
+  def add_packet(self, message_type, values, valid=True, source=0, timestamp=None):
+    if message_type != 0x01:
+      node_id_index = NODE_ID_INDEX.get(message_type)
+      if node_id_index is None:
+        return None
+      if valid and message_type == 0x02:
+        self.current_nodes[source] = values[node_id_index]
+      return values[node_id_index]
+
+    current_node = self.current_nodes.get(source, 0)
+    if not valid:
+      return current_node
+
+    if timestamp is None:
+      timestamp = time.time()
+    with self.lock:
+      samples = self.nodes.get(current_node)
+      if samples is None:
+        samples = self.nodes[current_node] = NodeHistory(self.capacity)
+      samples.append(timestamp, values)
+    return current_node
+
+  #
+  # Returns the trajectory of `node` between `start` and `end`, downsampled to at most `points` samples.
+  def trajectory(self, node, start=None, end=None, points=500):
+    with self.lock:
+      history = self.nodes.get(node)
+      if history is None:
+        return None
+      samples = history.range(start, end)
+
+    indices = lttb(samples['x'], samples['y'], points)
+    if len(indices) == len(samples['t']):
+      return {name: values.tolist() for name, values in samples.items()}
+    return {name: [values[i] for i in indices] for name, values in samples.items()}
+
+  #
+  # The downsampled trajectory of every node, sent to clients when they connect.
+  # Computed at most once every `max_age` seconds, however many clients connect.
+  def snapshot(self, points=300, max_age=1.0):
+    now = time.time()
+    cached = self.snapshot_cache
+    if cached is not None and cached[1] == points and 0 <= now - cached[0] < max_age:
+      return cached[2]
+    with self.lock:
+      nodes = list(self.nodes)
+    snapshot = {str(node): self.trajectory(node, points=points) for node in nodes}
+    self.snapshot_cache = (now, points, snapshot)
+    return snapshot
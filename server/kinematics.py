@@ -0,0 +1,148 @@
+import time
+import math
+import logging
+from threading import Lock
+
+import numpy as np
+
+log = logging.getLogger('kinematics')
+
+#
+# Derived state of every node, computed once on the server from its 0x01 state messages.
+#
+# Each node keeps its latest `window` samples in a preallocated NumPy array that
+# is written in place per packet, so bursts cost no allocation. Velocity and turn
+# rate are least-squares slopes over the window, worked out only when the derived
+# state is published. Angles are in degrees, in the same convention as phi.
+KINEMATICS_COLUMNS = (
+  't',                  # time of the latest sample
+  'x', 'y',             # smoothed position
+  'heading',            # heading normalised to [0, 360)
+  'heading_unwrapped',  # heading without jumps at the wrap around
+  'vx', 'vy', 'speed',  # velocity in position units per second
+  'turn_rate',          # degrees per second
+  'sp_distance',        # distance from the smoothed position to the setpoint
+  'sp_error',           # bearing to the setpoint minus the heading, in [-180, 180)
+)
+
+# Columns of the per-node sample window
+_T, _X, _Y, _HEADING = range(4)
+
+def wrap_angle(degrees):
+  return (degrees + 180.0) % 360.0 - 180.0
+
+class NodeKinematics:
+  def __init__(self, window, smoothing):
+    self.window = window
+    self.smoothing = smoothing
+    self.samples = np.zeros((window, 4))
+    self.count = 0
+    self.index = 0
+    self.phi = None
+    self.heading = 0.0
+    self.x = 0.0
+    self.y = 0.0
+    self.sp_x = 0.0
+    self.sp_y = 0.0
+    self.updated = False
+
+  def update(self, timestamp, x, y, phi, sp_x, sp_y):
+    if self.phi is None:
+      self.heading = phi
+      self.x = x
+      self.y = y
+    else:
+      self.heading += wrap_angle(phi - self.phi)
+      self.x += self.smoothing * (x - self.x)
+      self.y += self.smoothing * (y - self.y)
+    self.phi = phi
+    self.sp_x = sp_x
+    self.sp_y = sp_y
+
+    row = self.samples[self.index]
+    row[_T] = timestamp
+    row[_X] = x
+    row[_Y] = y
+    row[_HEADING] = self.heading
+    self.index = (self.index + 1) % self.window
+    self.count = min(self.count + 1, self.window)
+    self.updated = True
+
+  #
+  # Returns the derived state as a list of values in KINEMATICS_COLUMNS order.
+  def derive(self):
+    samples = self.samples[:self.count]
+    latest = float(samples[(self.index - 1) % self.window, _T]) if self.count else 0.0
+
+    # Slopes of x, y and heading over time. The order of the samples in the
+    # ring does not matter for a least-squares fit, so the ring is not unrolled.
+    vx = vy = turn_rate = 0.0
+    if self.count >= 2:
+      t = samples[:, _T] - samples[:, _T].mean()
+      variance = t.dot(t)
+      if variance > 0:
+        vx, vy, turn_rate = (t.dot(samples[:, _X:]) / variance).tolist()
+
+    dx = self.sp_x - self.x
+    dy = self.sp_y - self.y
+    bearing = math.degrees(math.atan2(dy, dx))
+    return [
+      latest,
+      self.x, self.y,
+      self.heading % 360.0,
+      self.heading,
+      vx, vy, math.hypot(vx, vy),
+      turn_rate,
+      math.hypot(dx, dy),
+      wrap_angle(bearing - self.heading),
+    ]
+
+class KinematicsEngine:
+  def __init__(self, window=20, smoothing=0.3):
+    self.window = window
+    self.smoothing = smoothing
+    self.nodes = {}
+    self.lock = Lock()
+
+  #
+  # Adds the decoded values (x, y, phi, sp_x, sp_y) of a state message of `node`.
+  # Called from the serial reader thread.
+  def update(self, node, values, timestamp=None):
+    if timestamp is None:
+      timestamp = time.time()
+    with self.lock:
+      state = self.nodes.get(node)
+      if state is None:
+        state = self.nodes[node] = NodeKinematics(self.window, self.smoothing)
+      state.update(timestamp, *values)
+
+  #
+  # Returns the derived state of the nodes updated since the last call, keyed by node id.
+  def derive_updated(self):
+    result = {}
+    with self.lock:
+      for node, state in self.nodes.items():
+        if state.updated:
+          state.updated = False
+          result[str(node)] = state.derive()
+    return result
+
+#
+# A green thread that sends the derived state of the nodes that changed as a
+# `kinematics` event to every browser, `rate` times per second.
+def publish_kinematics(sio, engine, rate=5):
+  log.info("starting kinematics publisher")
+  interval = 1.0 / rate
+  while True:
+    nodes = engine.derive_updated()
+    if nodes:
+      try:
+        sio.emit('kinematics', {
+          '_id': 0,
+          'type': 'kinematics',
+          'columns': KINEMATICS_COLUMNS,
+          'nodes': nodes,
+        })
+      except Exception:
+        log.exception("kinematics emit failed")
+    sio.sleep(interval)
@@ -0,0 +1,297 @@
+import os
+import sys
+import tty
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from struct import Struct
+
+from synthetic import SimulatedBoat, staterq_frame, control_frame, user_frame, corrupt_frame, garbage_bytes
+from wire import decode_binary
+
+try:
+  import socketio
+except ImportError:
+  socketio = None
+
+#
+# End-to-end load test of the whole server over a virtual serial port.
+#
+# The server is started as a separate process reading one end of a pty pair,
+# exactly as it reads a base station. Simulated boats write state polls, control
+# messages and optional noise and corruption into the other end, and headless
+# Socket.IO clients subscribe like browsers do. Probe messages (user messages
+# carrying a sequence number) are written at a steady rate to measure the time from
+# writing a frame to a client receiving it, and to count the ones that never arrive.
+# Needs Linux for /proc and the Socket.IO client (pip install "python-socketio[client]"):
+#
+#   python3 server/loadgen.py --boats 10 --rate 20 --clients 20 --duration 60 -o load.json
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--boats", help="Number of simulated boats", type=int, default=3)
+parser.add_argument("--rate", help="State polls per boat per second", type=float, default=10)
+parser.add_argument("--control-rate", help="Control messages per boat per second", type=float, default=1)
+parser.add_argument("--probe-rate", help="Latency probes per second", type=float, default=20)
+parser.add_argument("--noise", help="Standard deviation of the position noise", type=float, default=0.0)
+parser.add_argument("--garbage", help="Chance of garbage bytes after a frame", type=float, default=0.0)
+parser.add_argument("--truncated", help="Chance of a frame being cut short", type=float, default=0.0)
+parser.add_argument("--crc-errors", help="Chance of a corrupted frame", type=float, default=0.0)
+parser.add_argument("--clients", help="Number of headless Socket.IO clients", type=int, default=5)
+parser.add_argument("--wire", help="Message format the clients subscribe to", choices=("json", "binary"), default="binary")
+parser.add_argument("--duration", help="Seconds to measure for", type=float, default=30)
+parser.add_argument("--warmup", help="Seconds to run before measuring", type=float, default=3)
+parser.add_argument("--port", help="Port to start the server on", type=int, default=5055)
+parser.add_argument("--seed", help="Random seed for the traffic", type=int, default=1)
+parser.add_argument("--keep", help="Keep the server log and recording instead of deleting them at the end", action="store_true")
+parser.add_argument("-o", "--output", help="Write the JSON results to this file instead of stdout", type=str)
+
+# Probe payloads start with this marker, followed by the sequence number
+PROBE = Struct('<4sI')
+PROBE_MARKER = b'LGEN'
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#
+# Writes the traffic of the simulated boats into the pty at the configured rates.
+class TrafficWriter:
+  def __init__(self, fd, args):
+    self.fd = fd
+    self.args = args
+    self.rng = random.Random(args.seed)
+    self.boats = [SimulatedBoat(node_id, rng=self.rng) for node_id in range(1, args.boats + 1)]
+    self.frames = 0
+    self.bytes = 0
+    self.probes = 0
+    # Probe sequence number -> time written
+    self.probe_times = {}
+    self.measuring = False
+    self.stopped = False
+
+  def _frame(self, frame):
+    args = self.args
+    frame, _, _ = corrupt_frame(frame, self.rng, args.crc_errors, args.truncated)
+    if args.garbage and self.rng.random() < args.garbage:
+      frame += garbage_bytes(self.rng)
+    return frame
+
+  def _write(self, data):
+    view = memoryview(data)
+    while view:
+      written = os.write(self.fd, view)
+      view = view[written:]
+    if self.measuring:
+      self.bytes += len(data)
+
+  def run(self):
+    args = self.args
+    tick = 1.0 / args.rate
+    next_tick = next_probe = time.time()
+    control_chance = args.control_rate / args.rate
+    while not self.stopped:
+      now = time.time()
+      if now >= next_probe:
+        seq = self.probes
+        self.probes += 1
+        self.probe_times[seq] = time.time()
+        self._write(user_frame(PROBE.pack(PROBE_MARKER, seq)))
+        next_probe += 1.0 / args.probe_rate
+
+      if now >= next_tick:
+        out = bytearray()
+        count = 0
+        for boat in self.boats:
+          out += self._frame(staterq_frame(boat.node_id))
+          out += self._frame(boat.step(args.noise))
+          count += 2
+          if self.rng.random() < control_chance:
+            out += self._frame(control_frame(boat.node_id, self.rng.randrange(4), self.rng.uniform(-1, 1)))
+            count += 1
+        self._write(out)
+        if self.measuring:
+          self.frames += count
+        next_tick += tick
+
+      time.sleep(max(0, min(next_tick, next_probe) - time.time()))
+
+#
+# A headless browser: subscribes like the frontend and records what it receives.
+class LoadClient:
+  def __init__(self, url, wire, writer):
+    self.writer = writer
+    self.wire = wire
+    self.messages = 0
+    # Probe sequence number -> latency
+    self.probes = {}
+    self.sio = socketio.Client(reconnection=False)
+    self.sio.on('connect', lambda: self.sio.emit('subscribe', {'format': wire}))
+    self.sio.on('messages', self.on_messages)
+    self.sio.on('messages_bin', self.on_messages_bin)
+    self.sio.connect(url, transports=['websocket'])
+
+  def on_messages(self, messages):
+    for message in messages:
+      if message.get('type') == 'serial':
+        self._received(message['msg'], bytes.fromhex(message['raw_data']))
+
+  def on_messages_bin(self, data):
+    for _, _, _, message_type, _, raw in decode_binary(data):
+      self._received(message_type, raw)
+
+  def _received(self, message_type, raw):
+    if self.writer.measuring:
+      self.messages += 1
+    # A probe is 0xAA 0x04, a header byte, a length byte, the probe and the CRC
+    if message_type == 4 and len(raw) == 4 + PROBE.size + 2 and raw[4:8] == PROBE_MARKER:
+      _, seq = PROBE.unpack_from(raw, 4)
+      sent = self.writer.probe_times.get(seq)
+      if sent is not None and seq not in self.probes:
+        self.probes[seq] = time.time() - sent
+
+  def close(self):
+    self.sio.disconnect()
+
+# CPU seconds used by a process so far, from /proc
+def process_cpu(pid):
+  with open('/proc/%d/stat' % pid) as f:
+    fields = f.read().rsplit(')', 1)[1].split()
+  return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def wait_for_server(url, process, timeout=30):
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    if process.poll() is not None:
+      raise RuntimeError('server exited with code %d' % process.returncode)
+    try:
+      urllib.request.urlopen(url + '/metrics', timeout=1).read()
+      return
+    except OSError:
+      time.sleep(0.2)
+  raise RuntimeError('server did not start within %d seconds' % timeout)
+
+# Values of the unlabelled metrics in the Prometheus text of /metrics
+def scrape(url):
+  values = {}
+  for line in urllib.request.urlopen(url + '/metrics', timeout=5).read().decode().splitlines():
+    if line.startswith('#') or '{' in line or ' ' not in line:
+      continue
+    name, value = line.rsplit(' ', 1)
+    values[name] = float(value)
+  return values
+
+def percentiles(latencies):
+  latencies = sorted(latencies)
+  if not latencies:
+    return {'count': 0}
+  at = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+  return {
+    'count': len(latencies),
+    'mean': sum(latencies) / len(latencies),
+    'p50': at(0.5),
+    'p95': at(0.95),
+    'p99': at(0.99),
+    'max': latencies[-1],
+  }
+
+def run(args):
+  if socketio is None:
+    raise SystemExit('the load generator needs the Socket.IO client: pip install "python-socketio[client]"')
+
+  master, slave = os.openpty()
+  tty.setraw(slave)
+  # The server's log and recording, deleted at the end unless --keep is given
+  workdir = tempfile.mkdtemp(prefix='kfst-loadgen-')
+  server_log = open(os.path.join(workdir, 'server.log'), 'w')
+  url = 'http://127.0.0.1:%d' % args.port
+  server = subprocess.Popen(
+    [sys.executable, SERVER, '-d', os.ttyname(slave), '--port', str(args.port), '-r', os.path.join(workdir, 'recordings')],
+    cwd=ROOT, stdout=subprocess.DEVNULL, stderr=server_log)
+
+  writer = TrafficWriter(master, args)
+  clients = []
+  try:
+    wait_for_server(url, server)
+    clients = [LoadClient(url, args.wire, writer) for _ in range(args.clients)]
+    thread = threading.Thread(target=writer.run, daemon=True)
+    thread.start()
+    time.sleep(args.warmup)
+
+    before = scrape(url)
+    server_cpu = process_cpu(server.pid)
+    own_cpu = sum(os.times()[:2])
+    first_probe = writer.probes
+    writer.measuring = True
+    started = time.time()
+    time.sleep(args.duration)
+    writer.measuring = False
+    elapsed = time.time() - started
+    last_probe = writer.probes
+    server_cpu = process_cpu(server.pid) - server_cpu
+    own_cpu = sum(os.times()[:2]) - own_cpu
+    after = scrape(url)
+    # Give the last probes time to arrive
+    time.sleep(1)
+  finally:
+    writer.stopped = True
+    for client in clients:
+      try:
+        client.close()
+      except Exception:
+        pass
+    server.terminate()
+    server.wait()
+    server_log.close()
+    os.close(master)
+    os.close(slave)
+    if not args.keep:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+  probes = last_probe - first_probe
+  # Only probes sent while measuring count, however late they arrived
+  latencies = [[latency for seq, latency in client.probes.items() if first_probe <= seq < last_probe] for client in clients]
+  delta = lambda name: after.get(name, 0) - before.get(name, 0)
+  return {
+    'timestamp': time.time(),
+    'settings': vars(args),
+    'offered': {
+      'seconds': elapsed,
+      'frames_per_sec': writer.frames / elapsed,
+      'bytes_per_sec': writer.bytes / elapsed,
+      # 8N1 serial framing sends 10 bits per byte
+      'equivalent_baud': writer.bytes / elapsed * 10,
+    },
+    'clients': {
+      'count': len(clients),
+      'messages_per_sec': [client.messages / elapsed for client in clients],
+      'probes_sent': probes,
+      'probes_lost': [probes - len(received) for received in latencies],
+    },
+    'latency_seconds': percentiles(latency for received in latencies for latency in received),
+    'cpu': {
+      'server_percent': 100 * server_cpu / elapsed,
+      'loadgen_percent': 100 * own_cpu / elapsed,
+    },
+    'server': {
+      'bytes_read': delta('serial_bytes_read_total'),
+      'garbage_bytes': delta('serial_garbage_bytes_total'),
+      'queue_dropped': delta('emitter_queue_dropped_total'),
+      'batches': delta('emitter_batches_total'),
+      'emit_errors': delta('emitter_errors_total'),
+    },
+    'server_log': server_log.name if args.keep else None,
+  }
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  results = json.dumps(run(args), indent=2)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(results + '\n')
+  else:
+    print(results)
@@ -0,0 +1,67 @@
+import logging
+import time
+
+#
+# Logging setup for the server.
+#
+# Records are written as logfmt lines (time=... level=... logger=... msg="...")
+# followed by any fields passed with `extra={'fields': {...}}`. A filter limits
+# how often the same message can be logged, so an error that repeats for every
+# packet cannot flood the logs.
+
+class LogfmtFormatter(logging.Formatter):
+  def format(self, record):
+    parts = [
+      'time=%s' % time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)),
+      'level=%s' % record.levelname,
+      'logger=%s' % record.name,
+      'msg=%s' % _quote(record.getMessage()),
+    ]
+    fields = getattr(record, 'fields', None)
+    if fields:
+      parts.extend('%s=%s' % (key, _quote(value)) for key, value in fields.items())
+    suppressed = getattr(record, 'suppressed', 0)
+    if suppressed:
+      parts.append('suppressed=%d' % suppressed)
+    if record.exc_info:
+      parts.append('exc=%s' % _quote(self.formatException(record.exc_info)))
+    return ' '.join(parts)
+
+def _quote(value):
+  text = str(value)
+  if text and not any(c in text for c in ' "=\n'):
+    return text
+  return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+#
+# Lets through at most `rate` records with the same message template per `interval` seconds.
+# The next record let through after a window reports how many were suppressed.
+class RateLimitFilter(logging.Filter):
+  def __init__(self, rate=10, interval=10.0):
+    super().__init__()
+    self.rate = rate
+    self.interval = interval
+    self.windows = {}
+
+  def filter(self, record):
+    key = (record.name, record.msg)
+    now = record.created
+    started, count, suppressed = self.windows.get(key, (now, 0, 0))
+    if now - started >= self.interval:
+      started, count = now, 0
+
+    if count >= self.rate:
+      self.windows[key] = (started, count, suppressed + 1)
+      return False
+
+    record.suppressed = suppressed
+    self.windows[key] = (started, count + 1, 0)
+    return True
+
+def setup_logging(level='INFO', rate=10, interval=10.0):
+  handler = logging.StreamHandler()
+  handler.setFormatter(LogfmtFormatter())
+  handler.addFilter(RateLimitFilter(rate, interval))
+  root = logging.getLogger()
+  root.handlers = [handler]
+  root.setLevel(level.upper() if isinstance(level, str) else level)
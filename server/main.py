@@ -1,17 +1,30 @@
 from threading import Thread
-from queue import Queue
 import time
+import math
+import signal
 import argparse
+import logging
 from random import sample
 
-from flask import Flask
-from flask_socketio import SocketIO
+from flask import Flask, request, jsonify, abort, Response
+from flask_socketio import SocketIO, join_room, leave_room, emit
 
-from serial_reader import reader
+from serial_reader import ReaderThread, replay
+from recorder import Recorder
+from history import StateHistory
+from spatial_index import TrajectoryIndex
+from kinematics import KinematicsEngine, publish_kinematics
+from emitter import MessageQueue, SentTimes, emit_batches, conflate_latest, LATENCY, ACK_LATENCY
+from subscriptions import Subscriptions, Conflator, parse_subscription
 from config import load_config
+from static_files import StaticFiles
+from log import setup_logging
+import metrics
 
 import os
 
+log = logging.getLogger('main')
+
 ##
 ## Command line arguments
 ##
@@ -20,19 +33,218 @@ parser = argparse.ArgumentParser()
 parser.add_argument("-d", "--serial_device", help="The serial device to listen for data on", type=str)
 parser.add_argument("-b", "--baudrate", help="The baud rate of the serial device", type=int)
 parser.add_argument("-t", "--test", help="Enable testing mode (no serial port setup needed)", action="store_true")
+parser.add_argument("-r", "--record", help="Record raw serial frames into this directory", type=str)
+parser.add_argument("--replay", help="Replay a recorded segment file instead of reading the serial device", type=str)
+parser.add_argument("--speed", help="Replay speed as a multiple of real time, 0 to replay as fast as possible", type=float, default=1.0)
+parser.add_argument("--skip", help="Seconds to skip from the start of the replayed recording", type=float, default=0)
+parser.add_argument("--role", help="all: read the serial device and serve clients in this process. "
+                                   "ingest: only read the serial device into the shared ring. "
+                                   "web: only serve clients from the shared ring",
+                    choices=("all", "ingest", "web"), default="all")
+parser.add_argument("--port", help="The port to serve the web app on", type=int, default=5000)
 
 ##
 ## Web app setup
 ##
 
-app = Flask(__name__, static_url_path='', static_folder='static')
+app = Flask(__name__, static_folder=None)
 app.config['SECRET_KEY'] = 'hunter2'
 sio = SocketIO(app)
 
-# Static folder configuration will load static files from ./static/
+# The frontend build is served from ./static/, precompressed and with cache headers
+static_files = StaticFiles(os.path.join(app.root_path, 'static'))
+
 @app.route('/')
 def indexpage():
-    return app.send_static_file('index.html')
+    return static_files.serve('index.html')
+
+@app.route('/<path:filename>')
+def static_file(filename):
+    return static_files.serve(filename)
+
+# Counters and histograms of the serial pipeline in the Prometheus text format
+@app.route('/metrics')
+def metrics_page():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+# Latency percentiles in seconds, from reading a frame to sending it and to a browser drawing it
+@app.route('/api/latency')
+def latency():
+    return jsonify({
+        name: {
+            'count': histogram.count,
+            'p50': histogram.quantile(0.5),
+            'p95': histogram.quantile(0.95),
+            'p99': histogram.quantile(0.99),
+        }
+        for name, histogram in (('read_to_emit', LATENCY), ('read_to_screen', ACK_LATENCY))
+    })
+
+##
+## State history
+##
+
+def get_history_config():
+    conf = load_config().get("history") or {}
+    return {
+        'capacity': conf.get("capacity", 36000),
+        'snapshot_points': conf.get("snapshot_points", 300),
+    }
+
+history_config = get_history_config()
+history = StateHistory(history_config['capacity'])
+
+# Returns the downsampled trajectory of one node, e.g. /api/trajectory?node=1&start=1559000000&points=300
+@app.route('/api/trajectory')
+def trajectory():
+    node = request.args.get('node', 0, type=int)
+    start = request.args.get('start', None, type=float)
+    end = request.args.get('end', None, type=float)
+    if any(t is not None and not math.isfinite(t) for t in (start, end)):
+        abort(400)
+    points = request.args.get('points', 500, type=int)
+    result = history.trajectory(node, start, end, points)
+    if result is None:
+        abort(404)
+    return jsonify(result)
+
+def get_spatial_index_config():
+    conf = load_config().get("spatial_index") or {}
+    return {
+        'cell_size': conf.get("cell_size", 5.0),
+        'levels': conf.get("levels", 10),
+        'bucket_seconds': conf.get("bucket_seconds", 60),
+        'retention': conf.get("retention_hours", 12) * 3600,
+    }
+
+trajectory_index = TrajectoryIndex(**get_spatial_index_config())
+
+# Grid cells are drawn about this many pixels wide
+PIXELS_PER_CELL = 4
+
+# Returns the positions inside an area and time window, at a resolution that fits the view, e.g.
+# /api/positions?bbox=-100,-100,100,100&start=1559000000&end=1559003600&width=800
+# `width` is the width of the view in pixels and `max_points` caps the number of points returned.
+# `level` picks a level of the grid directly instead.
+@app.route('/api/positions')
+def positions():
+    try:
+        bbox = [float(v) for v in request.args.get('bbox', '').split(',')]
+        if len(bbox) != 4 or not all(math.isfinite(v) for v in bbox) or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ValueError
+    except ValueError:
+        abort(400)
+    start = request.args.get('start', None, type=float)
+    end = request.args.get('end', None, type=float)
+    if any(t is not None and not math.isfinite(t) for t in (start, end)):
+        abort(400)
+    nodes = request.args.get('nodes', None, type=str)
+    if nodes:
+        if not all(node.isdigit() for node in nodes.split(',')):
+            abort(400)
+        nodes = set(int(node) for node in nodes.split(','))
+    level = request.args.get('level', None, type=int)
+    if level is None:
+        width = max(request.args.get('width', 1000, type=int), 1)
+        max_points = request.args.get('max_points', 5000, type=int)
+        resolution = (bbox[2] - bbox[0]) / width * PIXELS_PER_CELL
+        level, result = trajectory_index.query_view(bbox, start, end, resolution, max_points, nodes or None)
+    else:
+        level = max(0, min(level, trajectory_index.levels - 1))
+        result = trajectory_index.query(bbox, start, end, level, nodes or None)
+    return jsonify({
+        'level': level,
+        'cell_size': trajectory_index.level_size(level),
+        'nodes': result,
+    })
+
+##
+## Derived state
+## Heading, velocity, turn rate and setpoint error of every node, sent as `kinematics` events
+##
+
+def get_kinematics_config():
+    conf = load_config().get("kinematics") or {}
+    return {
+        'window': conf.get("window", 20),
+        'smoothing': conf.get("smoothing", 0.3),
+        'rate': conf.get("rate", 5),
+    }
+
+kinematics_config = get_kinematics_config()
+kinematics = KinematicsEngine(kinematics_config['window'], kinematics_config['smoothing'])
+
+##
+## Socket.IO clients
+## Every client gets every message as JSON until it changes its subscription with `subscribe`
+##
+
+subscriptions = Subscriptions()
+conflator = Conflator()
+sent_times = SentTimes()
+
+def get_subscription_config():
+    conf = load_config().get("subscriptions") or {}
+    return {
+        'max_rate': conf.get("max_rate", 10),
+    }
+
+subscription_config = get_subscription_config()
+
+def update_subscription(data):
+    current = subscriptions.get(request.sid)
+    try:
+        subscription = parse_subscription(data, current, subscription_config['max_rate'])
+    except (ValueError, TypeError) as e:
+        emit('subscription_error', str(e))
+        return
+    leave_room(current.room)
+    join_room(subscription.room)
+    subscriptions.set(request.sid, subscription)
+
+@sio.on('connect')
+def on_connect(auth=None):
+    subscription = subscriptions.get(request.sid)
+    join_room(subscription.room)
+    subscriptions.set(request.sid, subscription)
+    emit('snapshot', {
+        '_id': 0,
+        'type': 'snapshot',
+        'nodes': history.snapshot(history_config['snapshot_points'])
+    })
+
+# e.g. { "format": "binary", "types": [1, 2], "nodes": [1], "mode": "latest", "rate": 5 }
+@sio.on('subscribe')
+def on_subscribe(data):
+    update_subscription(data)
+
+@sio.on('set_format')
+def on_set_format(fmt):
+    update_subscription({'format': fmt})
+
+# Browsers acknowledge the newest serial message they have drawn, about once a second
+@sio.on('ack')
+def on_ack(message_id):
+    if isinstance(message_id, int):
+        sent_times.ack(message_id)
+
+@sio.on('disconnect')
+def on_disconnect(*args):
+    subscriptions.remove(request.sid)
+
+# Re-reads config.yml and restarts the serial reader with its devices, e.g.
+# curl -X POST localhost:5000/reload -H 'Content-Type: application/json' -d '{"file": "/dev/ttyUSB1", "baudrate": 115200}'
+@app.route('/reload', methods=['POST'])
+def reload():
+    if serial_reader is None:
+        abort(409)
+    data = request.get_json(silent=True) or {}
+    try:
+        devices = reload_serial(data.get('file'), data.get('baudrate'))
+    except Exception as e:
+        log.warning("serial reload failed", extra={'fields': {'error': str(e)}})
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'devices': devices})
 
 @app.route('/restart', methods=['POST'])
 def restart():
@@ -82,39 +294,95 @@ def get_config(args):
     
     return filename, baud
 
-##
-## A green thread that gets the first message on the queue and sends it to the browser
-## This function cannot block!
-##
-
-def serial_listener(sio, q):
-    print("+ starting serial-emitter-thread")
-    while True:
-        try:
-            message = q.get(block=False)
-            print(">>>> emitting >>>>", message['raw_data'])
-            sio.emit('message', message)
-            sio.sleep(0.02)
-        except Exception as e:
-            sio.sleep(0.02)
+# The serial devices to read, as a list of { id, file, baudrate }.
+# The command line device and a single `serial_device` in config.yml become source 0.
+def get_devices_config(args):
+    devices = load_config().get("serial_devices")
+    if args.serial_device is not None or not devices:
+        filename, baud = get_config(args)
+        return [{'id': 0, 'file': filename, 'baudrate': baud}]
+
+    result = []
+    for i, device in enumerate(devices):
+        source_id = int(device.get("id", i))
+        if not 0 <= source_id <= 255:
+            raise ValueError("serial device id must be between 0 and 255: %d" % source_id)
+        result.append({
+            'id': source_id,
+            'file': device["file"],
+            'baudrate': device.get("baudrate", 57600),
+        })
+    return result
+
+def get_serial_reader_config():
+    conf = load_config().get("serial_reader") or {}
+    return {
+        'coalesce_delay': conf.get("coalesce_delay", 0),
+    }
+
+def get_emitter_config():
+    conf = load_config().get("emitter") or {}
+    return {
+        'queue_size': conf.get("queue_size", 2000),
+        'flush_interval': conf.get("flush_interval", 0.05),
+        'batch_size': conf.get("batch_size", 200),
+    }
+
+def get_logging_config():
+    conf = load_config().get("logging") or {}
+    return {
+        'level': conf.get("level", "INFO"),
+        'rate': conf.get("rate_limit", 10),
+        'interval': conf.get("rate_interval", 10.0),
+    }
+
+def get_recorder_config(args):
+    conf = load_config().get("recorder") or {}
+    directory = conf.get("directory")
+    if args.record is not None:
+        directory = args.record
+    if directory is None:
+        return None
+    return {
+        'directory': directory,
+        'segment_size': conf.get("segment_size_mb", 64) * 1024 * 1024,
+        'index_interval': conf.get("index_interval", 1.0),
+        'max_total_size': conf.get("max_total_mb", 1024) * 1024 * 1024,
+    }
+
+def get_ring_config():
+    conf = load_config().get("ring") or {}
+    return {
+        'name': conf.get("name", "kfst-frames"),
+        'slots': conf.get("slots", 16384),
+        'slot_size': conf.get("slot_size", 288),
+    }
 
 ##
-## A Python thread that stuffs Serial messages into the queue
-## 
+## Turns decoded packets and status updates into messages on the queue
+##
 
-def serial_thread(q, filename, baud):
+def make_message_sinks(q):
     id_ticker = 0
-    def tick(message_type, packet_raw_data, parsed={}, valid=True):
+    # `values` are the decoded fields in the order of the message format, the dict is only built for JSON clients
+    def tick(message_type, packet_raw_data, values=(), valid=True, source=0, t_rx=None):
         nonlocal id_ticker
         id_ticker += 1
+        node = history.add_packet(message_type, values, valid, source, t_rx)
+        if message_type == 0x01 and valid:
+            kinematics.update(node, values, t_rx)
+            trajectory_index.add(node, values[0], values[1], t_rx)
 
         message = {
             '_id': id_ticker,
             'type': 'serial',
             'msg': message_type,
-            'raw_data': packet_raw_data.hex(),
-            'parsed': parsed,
-            'valid': valid
+            'source': source,
+            'node': node,
+            'raw': packet_raw_data,
+            'values': values,
+            'valid': valid,
+            't_rx': t_rx if t_rx is not None else time.time()
         }
         q.put(message)
 
@@ -130,8 +398,62 @@ def serial_thread(q, filename, baud):
             message['details'] = details
         q.put(message)
 
-    print("+ subscribing to serial")
-    reader(filename, baud, tick, emit_status)
+    return tick, emit_status
+
+##
+## A Python thread that stuffs Serial messages into the queue
+## It is restarted on /reload or SIGHUP with the devices in config.yml, keeping the clients and the history
+## 
+
+serial_reader = None
+
+# `filename` and `baudrate` replace the -d and -b command line flags for this and later reloads
+def reload_serial(filename=None, baudrate=None):
+    if baudrate is not None:
+        args.baudrate = int(baudrate)
+    if filename is not None:
+        args.serial_device = str(filename)
+    devices = get_devices_config(args)
+    coalesce_delay = get_serial_reader_config()['coalesce_delay']
+
+    started = time.time()
+    serial_reader.restart(devices, coalesce_delay)
+    log.info("serial reader reloaded", extra={'fields': {
+        'devices': ','.join(device['file'] for device in devices),
+        'seconds': round(time.time() - started, 4),
+    }})
+    return devices
+
+def on_sighup(signum, frame):
+    def run():
+        try:
+            reload_serial()
+        except Exception:
+            log.exception("serial reload failed")
+    Thread(target=run, daemon=True).start()
+
+##
+## A Python thread that replays a recording into the queue
+##
+
+def replay_thread(tick, emit_status, filename, speed, skip):
+    replay(filename, speed, tick, emit_status, skip)
+
+##
+## A Python thread that follows the shared ring of the ingest process into the queue (--role web)
+##
+
+def attach_ring(name):
+    while True:
+        try:
+            return SharedRing.attach(name)
+        except FileNotFoundError:
+            log.info("waiting for the ingest process", extra={'fields': {'ring': name}})
+            time.sleep(1)
+
+def ring_thread(q, ring):
+    tick, emit_status = make_message_sinks(q)
+    follow(ring, tick, emit_status)
 
 ##
 ## A testing-only green thread that sends random valid messages to the Socket
@@ -144,8 +466,7 @@ def test_serial_listener(sio):
         {"type":"serial","msg":2,"raw_data":"aa02010c1e","parsed":{"node_id":1}},
         {"type":"serial","msg":1,"raw_data":"aa0100000000000000000eebc3440040bcc40080bb44af1d","parsed":{"x":0,"y":0,"phi":1567.345458984375,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa01000000000000000026ecc3440040bcc40080bb44f3a8","parsed":{"x":0,"y":0,"phi":1567.379638671875,"sp_x":-1506,"sp_y":1500}},
-        {"type":"serial","msg":4,"raw_data":"aa04","parsed":{}},
-        {"type":"serial","msg":4,"raw_data":"aa04020101dbab","parsed":{}},
+        {"type":"serial","msg":4,"raw_data":"aa04aa04020101dbab","parsed":{}},
         {"type":"serial","msg":1,"raw_data":"aa0100000000000000003eedc3440040bcc40080bb440719","parsed":{"x":0,"y":0,"phi":1567.413818359375,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa01000000000000000056eec3440040bcc40080bb44d7ab","parsed":{"x":0,"y":0,"phi":1567.447998046875,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa0100000000000000006eefc3440040bcc40080bb444dba","parsed":{"x":0,"y":0,"phi":1567.482177734375,"sp_x":-1506,"sp_y":1500}},
@@ -153,12 +474,10 @@ def test_serial_listener(sio):
         {"type":"serial","msg":1,"raw_data":"aa0100000000000000009ef1c3440040bcc40080bb4465ec","parsed":{"x":0,"y":0,"phi":1567.550537109375,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa010000000000000000b6f2c3440040bcc40080bb44681e","parsed":{"x":0,"y":0,"phi":1567.584716796875,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa010000000000000000cef3c3440040bcc40080bb442f4f","parsed":{"x":0,"y":0,"phi":1567.618896484375,"sp_x":-1506,"sp_y":1500}},
-        {"type":"serial","msg":4,"raw_data":"aa04","parsed":{}},
-        {"type":"serial","msg":4,"raw_data":"aa04020101dbab","parsed":{}},
+        {"type":"serial","msg":4,"raw_data":"aa04aa04020101dbab","parsed":{}},
         {"type":"serial","msg":1,"raw_data":"aa010000000000000000eed2c4440040bcc40080bb442f26","parsed":{"x":0,"y":0,"phi":1574.591552734375,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa01000000000000000006d4c4440040bcc40080bb44dc3b","parsed":{"x":0,"y":0,"phi":1574.625732421875,"sp_x":-1506,"sp_y":1500}},
-        {"type":"serial","msg":4,"raw_data":"aa04","parsed":{}},
-        {"type":"serial","msg":4,"raw_data":"aa04020101dbab","parsed":{}},
+        {"type":"serial","msg":4,"raw_data":"aa04aa04020101dbab","parsed":{}},
         {"type":"serial","msg":1,"raw_data":"aa0100000000000000001ed5c4440040bcc40080bb44288a","parsed":{"x":0,"y":0,"phi":1574.659912109375,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa01000000000000000036d6c4440040bcc40080bb442578","parsed":{"x":0,"y":0,"phi":1574.694091796875,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa0100000000000000004ed7c4440040bcc40080bb446229","parsed":{"x":0,"y":0,"phi":1574.728271484375,"sp_x":-1506,"sp_y":1500}},
@@ -167,8 +486,7 @@ def test_serial_listener(sio):
         {"type":"serial","msg":1,"raw_data":"aa01000000000000000096dac4440040bcc40080bb4412b0","parsed":{"x":0,"y":0,"phi":1574.830810546875,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":2,"raw_data":"aa02010c1e","parsed":{"node_id":1}},
         {"type":"serial","msg":1,"raw_data":"aa010000000000000000aedbc4440040bcc40080bb4488a1","parsed":{"x":0,"y":0,"phi":1574.864990234375,"sp_x":-1506,"sp_y":1500}},
-        {"type":"serial","msg":4,"raw_data":"aa04","parsed":{}},
-        {"type":"serial","msg":4,"raw_data":"aa04020101dbab","parsed":{}},
+        {"type":"serial","msg":4,"raw_data":"aa04aa04020101dbab","parsed":{}},
         {"type":"serial","msg":1,"raw_data":"aa010000000000000000deddc4440040bcc40080bb44fde5","parsed":{"x":0,"y":0,"phi":1574.933349609375,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa010000000000000000f6dec4440040bcc40080bb44f017","parsed":{"x":0,"y":0,"phi":1574.967529296875,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa0100000000000000000ee0c4440040bcc40080bb446993","parsed":{"x":0,"y":0,"phi":1575.001708984375,"sp_x":-1506,"sp_y":1500}},
@@ -176,8 +494,7 @@ def test_serial_listener(sio):
         {"type":"serial","msg":1,"raw_data":"aa0100000000000000003ee2c4440040bcc40080bb4490d0","parsed":{"x":0,"y":0,"phi":1575.070068359375,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa01000000000000000056e3c4440040bcc40080bb44e0d1","parsed":{"x":0,"y":0,"phi":1575.104248046875,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa0100000000000000006ee4c4440040bcc40080bb448b34","parsed":{"x":0,"y":0,"phi":1575.138427734375,"sp_x":-1506,"sp_y":1500}},
-        {"type":"serial","msg":4,"raw_data":"aa04","parsed":{}},
-        {"type":"serial","msg":4,"raw_data":"aa04020101dbab","parsed":{}},
+        {"type":"serial","msg":4,"raw_data":"aa04aa04020101dbab","parsed":{}},
         {"type":"serial","msg":1,"raw_data":"aa01000000000000000086e5c4440040bcc40080bb445194","parsed":{"x":0,"y":0,"phi":1575.172607421875,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":2,"raw_data":"aa02010c1e","parsed":{"node_id":1}},
         {"type":"serial","msg":1,"raw_data":"aa0100000000000000009ee6c4440040bcc40080bb440596","parsed":{"x":0,"y":0,"phi":1575.206787109375,"sp_x":-1506,"sp_y":1500}},
@@ -186,8 +503,7 @@ def test_serial_listener(sio):
         {"type":"serial","msg":1,"raw_data":"aa010000000000000000e6e9c4440040bcc40080bb4411bd","parsed":{"x":0,"y":0,"phi":1575.309326171875,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa010000000000000000feeac4440040bcc40080bb4445bf","parsed":{"x":0,"y":0,"phi":1575.343505859375,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa01000000000000000016ecc4440040bcc40080bb44b6a2","parsed":{"x":0,"y":0,"phi":1575.377685546875,"sp_x":-1506,"sp_y":1500}},
-        {"type":"serial","msg":4,"raw_data":"aa04","parsed":{}},
-        {"type":"serial","msg":4,"raw_data":"aa04020101dbab","parsed":{}},
+        {"type":"serial","msg":4,"raw_data":"aa04aa04020101dbab","parsed":{}},
         {"type":"serial","msg":1,"raw_data":"aa0100000000000000002eedc4440040bcc40080bb442cb3","parsed":{"x":0,"y":0,"phi":1575.411865234375,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa01000000000000000046eec4440040bcc40080bb44fc01","parsed":{"x":0,"y":0,"phi":1575.446044921875,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa0100000000000000005eefc4440040bcc40080bb4408b0","parsed":{"x":0,"y":0,"phi":1575.480224609375,"sp_x":-1506,"sp_y":1500}},
@@ -196,8 +512,7 @@ def test_serial_listener(sio):
         {"type":"serial","msg":1,"raw_data":"aa0100000000000000008ef1c4440040bcc40080bb444e46","parsed":{"x":0,"y":0,"phi":1575.548583984375,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa010000000000000000a6f2c4440040bcc40080bb4443b4","parsed":{"x":0,"y":0,"phi":1575.582763671875,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa010000000000000000bef3c4440040bcc40080bb44b705","parsed":{"x":0,"y":0,"phi":1575.616943359375,"sp_x":-1506,"sp_y":1500}},
-        {"type":"serial","msg":4,"raw_data":"aa04","parsed":{}},
-        {"type":"serial","msg":4,"raw_data":"aa04020101dbab","parsed":{}},
+        {"type":"serial","msg":4,"raw_data":"aa04aa04020101dbab","parsed":{}},
         {"type":"serial","msg":1,"raw_data":"aa010000000000000000eef5c4440040bcc40080bb44ace1","parsed":{"x":0,"y":0,"phi":1575.685302734375,"sp_x":-1506,"sp_y":1500}},
         {"type":"serial","msg":1,"raw_data":"aa01000000000000000006f7c4440040bcc40080bb440ebb","parsed":{"x":0,"y":0,"phi":1575.719482421875,"sp_x":-1506,"sp_y":1500}},
 
@@ -206,7 +521,7 @@ def test_serial_listener(sio):
         sampled_message = sample(messages, 1)[0]
         msg = { **sampled_message, '_id': id_ticker }
         id_ticker += 1
-        print(">>>> emitting >>>> ", id_ticker )
+        log.debug("emitting test message", extra={'fields': {'id': id_ticker}})
         sio.emit('message', msg)
         sio.sleep(0.15)
 
@@ -215,20 +530,64 @@ def test_serial_listener(sio):
 ##
 
 if __name__ == '__main__':
-    print("+ starting bg tasks")
-
-    q = Queue()
     args = parser.parse_args()
+    setup_logging(**get_logging_config())
+    log.info("starting bg tasks")
+
+    emitter_config = get_emitter_config()
+    q = MessageQueue(emitter_config['queue_size'])
+    metrics.gauge('emitter_queue_depth', 'Messages waiting to be sent', q.qsize)
+    metrics.gauge('emitter_queue_dropped_total', 'Messages dropped because the queue was full', lambda: q.dropped)
 
     if args.test:
-        print("+ TEST MODE: sending fake messages down the tube")
+        log.info("TEST MODE: sending fake messages down the tube")
         sio.start_background_task(test_serial_listener, sio)
     else:
-        filename, baud = get_config(args)
-        serial_thread = Thread(target=serial_thread, args=(q, filename, baud))
-        serial_thread.daemon = True
-        serial_thread.start()
-        sio.start_background_task(serial_listener, sio, q)
-
-    print("+ starting app on 0.0.0.0:5000")
-    sio.run(app, host='0.0.0.0', port=5000)
+        if args.role == 'web':
+            # shared_memory needs Python 3.8, so only the split roles import it
+            from shm_ring import SharedRing, follow
+            ring_config = get_ring_config()
+            ring = attach_ring(ring_config['name'])
+            log.info("WEB WORKER: serving clients from ring %s", ring_config['name'])
+            thread = Thread(target=ring_thread, args=(q, ring))
+            thread.daemon = True
+            thread.start()
+        else:
+            if args.role == 'ingest':
+                from shm_ring import SharedRing, make_ring_sinks
+                ring_config = get_ring_config()
+                ring = SharedRing.create(**ring_config)
+                log.info("INGEST: writing frames into ring %s", ring_config['name'])
+                tick, emit_status = make_ring_sinks(ring)
+            else:
+                tick, emit_status = make_message_sinks(q)
+
+            if args.replay:
+                log.info("REPLAY MODE: replaying %s", args.replay)
+                thread = Thread(target=replay_thread, args=(tick, emit_status, args.replay, args.speed, args.skip))
+                thread.daemon = True
+                thread.start()
+            else:
+                devices = get_devices_config(args)
+                recorder = None
+                recorder_config = get_recorder_config(args)
+                if recorder_config is not None:
+                    recorder = Recorder(**recorder_config)
+                    recorder.start()
+                    metrics.gauge('recorder_dropped_total', 'Frames not recorded because the writer fell behind', lambda: recorder.dropped)
+                coalesce_delay = get_serial_reader_config()['coalesce_delay']
+                log.info("subscribing to serial")
+                serial_reader = ReaderThread(tick, emit_status, recorder)
+                serial_reader.start(devices, coalesce_delay)
+                signal.signal(signal.SIGHUP, on_sighup)
+
+        # The ingest process only serves /metrics and /reload, the web workers serve the clients
+        if args.role != 'ingest':
+            sio.start_background_task(emit_batches, sio, q, subscriptions, conflator, sent_times,
+                                      emitter_config['flush_interval'],
+                                      emitter_config['batch_size'])
+            sio.start_background_task(conflate_latest, sio, subscriptions, conflator)
+            sio.start_background_task(publish_kinematics, sio, kinematics, kinematics_config['rate'])
+
+    log.info("starting app on 0.0.0.0:%d", args.port)
+    sio.run(app, host='0.0.0.0', port=args.port)
@@ -0,0 +1,132 @@
+import time
+from bisect import bisect_left
+
+#
+# Minimal in-process metrics, exposed in the Prometheus text format on /metrics.
+#
+# Metrics are created once at import time by the modules that update them. Each
+# metric is only updated from one thread (the serial reader or the emitter), so
+# updates need no locking.
+
+class Counter:
+  kind = 'counter'
+
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    # Unlabelled counters start at zero so they show up before the first increment
+    self.values = {} if labels else {(): 0}
+
+  def inc(self, amount=1, *label_values):
+    self.values[label_values] = self.values.get(label_values, 0) + amount
+
+  def samples(self):
+    for label_values, value in self.values.items():
+      yield self.name, dict(zip(self.labels, label_values)), value
+
+#
+# A value read from a function when metrics are collected, e.g. a queue length.
+class Gauge:
+  kind = 'gauge'
+
+  def __init__(self, name, help, fn=None):
+    self.name = name
+    self.help = help
+    self.fn = fn
+    self.value = 0
+
+  def set(self, value):
+    self.value = value
+
+  def set_function(self, fn):
+    self.fn = fn
+
+  def samples(self):
+    yield self.name, {}, self.fn() if self.fn is not None else self.value
+
+class Histogram:
+  kind = 'histogram'
+
+  def __init__(self, name, help, buckets):
+    self.name = name
+    self.help = help
+    self.buckets = sorted(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def samples(self):
+    cumulative = 0
+    for bound, count in zip(self.buckets, self.counts):
+      cumulative += count
+      yield self.name + '_bucket', {'le': repr(float(bound))}, cumulative
+    yield self.name + '_bucket', {'le': '+Inf'}, self.count
+    yield self.name + '_sum', {}, self.sum
+    yield self.name + '_count', {}, self.count
+
+  #
+  # Estimates the value below which `q` (0..1) of the observations fall,
+  # as the upper bound of the bucket that contains it.
+  def quantile(self, q):
+    if self.count == 0:
+      return None
+    target = q * self.count
+    cumulative = 0
+    for bound, count in zip(self.buckets, self.counts):
+      cumulative += count
+      if cumulative >= target:
+        return bound
+    return float('inf')
+
+# Histogram buckets for latencies, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class Registry:
+  def __init__(self):
+    self.metrics = {}
+    self.started = time.time()
+
+  def _add(self, metric):
+    if metric.name in self.metrics:
+      return self.metrics[metric.name]
+    self.metrics[metric.name] = metric
+    return metric
+
+  def counter(self, name, help, labels=()):
+    return self._add(Counter(name, help, labels))
+
+  def gauge(self, name, help, fn=None):
+    return self._add(Gauge(name, help, fn))
+
+  def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+    return self._add(Histogram(name, help, buckets))
+
+  def render(self):
+    lines = []
+    for metric in self.metrics.values():
+      lines.append('# HELP %s %s' % (metric.name, metric.help))
+      lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+      for name, labels, value in metric.samples():
+        if labels:
+          label_text = ','.join('%s="%s"' % (k, v) for k, v in labels.items())
+          lines.append('%s{%s} %s' % (name, label_text, value))
+        else:
+          lines.append('%s %s' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name, help, labels=()):
+  return REGISTRY.counter(name, help, labels)
+
+def gauge(name, help, fn=None):
+  return REGISTRY.gauge(name, help, fn)
+
+def histogram(name, help, buckets=LATENCY_BUCKETS):
+  return REGISTRY.histogram(name, help, buckets)
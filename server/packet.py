@@ -1,7 +1,17 @@
-
+#
+# A decoded serial packet.
+# `fields` holds the field names of the message type and `values` the decoded values in the same order.
 class Packet:
-  def __init__(self):
-    self.message_type = 0x00
-    self.parsed = {}
-    self.raw = b''
-    self.valid = True
\ No newline at end of file
+  __slots__ = ('message_type', 'raw', 'fields', 'values', 'valid')
+
+  def __init__(self, message_type=0x00, raw=b'', fields=(), values=(), valid=True):
+    self.message_type = message_type
+    self.raw = raw
+    self.fields = fields
+    self.values = values
+    self.valid = valid
+
+  # The decoded fields as a dict, built on demand
+  @property
+  def parsed(self):
+    return dict(zip(self.fields, self.values))
@@ -1,126 +1,109 @@
-from packet import Packet
-from struct import unpack
-import crc16
-
-
-def validate_crc(raw_packet, crc): 
-  crc_calculated = crc16.crc16xmodem(bytes(raw_packet[:-2]))
-  return crc == crc_calculated
-
-# 
-# Decode 0x01 messages: State
-def decode_state_msg(raw_packet):
-  if raw_packet[1] != 0x01:
-    print("- packet parser: decode_state_msg: raw packet not 0x01 type")
-    return None
-  
-  if len(raw_packet) != 24:
-    print("- packet parser: decode_state_msg: raw packet not 24 bytes", raw_packet.hex())
-    return None
+import logging
+from collections import namedtuple
+from struct import Struct
+from binascii import crc_hqx
 
-  unpacked = unpack('<ccfffffcc', raw_packet)
-
-  pkt = Packet()
-  pkt.message_type = 0x01
-  pkt.raw = raw_packet
-
-  state_msg = {
-    'x': unpacked[2],
-    'y': unpacked[3],
-    'phi': unpacked[4],
-    'sp_x': unpacked[5],
-    'sp_y': unpacked[6]
-  }
-
-  crc = ((int.from_bytes(unpacked[7], 'little') & 0xff) << 8) | (int.from_bytes(unpacked[8], 'little') & 0xff)
-  pkt.valid = validate_crc(raw_packet, crc)
-  pkt.parsed = state_msg
-  return pkt
-
-# 
-# Decode 0x02 messages: State Request
-def decode_staterq_msg(raw_packet):
-  if raw_packet[1] != 0x02:
-    print("- packet parser: decode_staterq_msg: raw packet not 0x02 type")
-    return None
-
-  if len(raw_packet) != 5:
-    print("- packet parser: decode_staterq_msg: raw packet not 5 bytes", raw_packet.hex())
-    return None
-  
-  unpacked = unpack('<ccccc', raw_packet)
- 
-  pkt = Packet()
-  pkt.message_type = 0x02
-  pkt.raw = raw_packet
+from packet import Packet
+from crc import crc16xmodem
+import metrics
 
-  staterq_msg = {
-    'node_id': int.from_bytes(unpacked[2], 'little')
-  }
+log = logging.getLogger('packet_parser')
 
-  crc = ((int.from_bytes(unpacked[3], 'little') & 0xff) << 8) | (int.from_bytes(unpacked[4], 'little') & 0xff)
-  pkt.valid = validate_crc(raw_packet, crc)
-  pkt.parsed = staterq_msg
+DECODE_ERRORS = metrics.counter('serial_decode_errors_total', 'Frames that did not match their message format by message type', ('type',))
 
-  return pkt
 
-# 
-# Decode 0x03 messages: Control Message
-def decode_control_msg(raw_packet):
-  if raw_packet[1] != 0x03:
-    print("- packet parser: decode_control_msg: raw packet not 0x03 type")
-    return None
+def validate_crc(raw_packet, crc): 
+  crc_calculated = crc16xmodem(memoryview(raw_packet)[:-2])
+  return crc == crc_calculated
 
-  if len(raw_packet) != 10:
-    print("- packet parser: decode_control_msg: raw packet not 10 bytes", raw_packet.hex())
+#
+# Describes how to decode one message type.
+#   length: full frame length including the 0xAA header and CRC, None when variable
+#   payload: precompiled struct that unpacks the fields from the frame, None when not decoded
+#   fields: names of the unpacked values
+#   length_offset: for variable length messages, the offset of a length byte that counts
+#     itself and the payload after it, so the frame is length_offset + length + 2 bytes long
+MessageFormat = namedtuple('MessageFormat', ['name', 'length', 'payload', 'fields', 'length_offset'])
+
+#
+# All known message types, keyed by the type byte that follows 0xAA.
+# The CRC is the last two bytes of every frame and is not part of the payload struct.
+MESSAGE_FORMATS = {
+  # 0x01 messages: State
+  0x01: MessageFormat('state', 24, Struct('<2x5f'), ('x', 'y', 'phi', 'sp_x', 'sp_y'), None),
+  # 0x02 messages: State Request
+  0x02: MessageFormat('staterq', 5, Struct('<2xB'), ('node_id',), None),
+  # 0x03 messages: Control Message
+  0x03: MessageFormat('control', 10, Struct('<2xBBf'), ('node_id', 'type', 'u'), None),
+  # 0x04 messages: User Message (no unpacking), 0xAA 0x04 header length payload
+  0x04: MessageFormat('user', None, None, (), 3),
+}
+
+#
+# Return the full frame length of a message type, or None if it is unknown or variable.
+def get_message_length(message_type):
+  fmt = MESSAGE_FORMATS.get(message_type)
+  if fmt is None:
     return None
-  
-  unpacked = unpack('<ccccfcc', raw_packet)
-
-  pkt = Packet()
-  pkt.message_type = 0x03
-  pkt.raw = raw_packet
-
-  control_msg = {
-    'node_id': int.from_bytes(unpacked[2], 'little'),
-    'type': int.from_bytes(unpacked[3], 'little'),
-    'u': unpacked[4]
-  }
-
-  crc = ((int.from_bytes(unpacked[5], 'little') & 0xff) << 8) | (int.from_bytes(unpacked[6], 'little') & 0xff)
-
-  pkt.valid = validate_crc(raw_packet, crc)
-  pkt.parsed = control_msg
-
-  return pkt
-
-# 
-# Decode 0x04 messages: User Message (no unpacking)
-def decode_user_msg(raw_packet):
-  if raw_packet[1] != 0x04:
-    print("- packet parser: decode_user_msg: raw packet not 0x04 type")
+  return fmt.length
+
+#
+# Return the field names of a message type, in the order of the decoded values.
+def get_fields(message_type):
+  fmt = MESSAGE_FORMATS.get(message_type)
+  if fmt is None:
+    return ()
+  return fmt.fields
+
+#
+# Return the offset of the length byte of a variable length message type, or None if it has none.
+def get_length_offset(message_type):
+  fmt = MESSAGE_FORMATS.get(message_type)
+  if fmt is None:
     return None
+  return fmt.length_offset
 
-  pkt = Packet()
-  pkt.message_type = 0x04
-  pkt.raw = raw_packet
-  crc = ((raw_packet[-2] & 0xff) << 8) | (raw_packet[-1] & 0xff)
-  pkt.valid = validate_crc(raw_packet, crc)
+#
+# Per message type: frame length, unpack function of the payload and field names,
+# looked up once per frame by parse_many.
+DECODERS = {
+  message_type: (fmt.length, fmt.payload.unpack_from if fmt.payload is not None else None, fmt.fields)
+  for message_type, fmt in MESSAGE_FORMATS.items()
+}
 
-  return pkt
+def _wrong_length(message_type, raw_packet):
+  fmt = MESSAGE_FORMATS[message_type]
+  DECODE_ERRORS.inc(1, message_type)
+  log.debug("%s message not %d bytes", fmt.name, fmt.length, extra={'fields': {'raw': raw_packet.hex()}})
 
 def parse_packet(raw_packet):
-  if len(raw_packet) < 2:
-    return None
-
-  if raw_packet[0] != 0xAA:
-    return None
-
-  if raw_packet[1] == 0x01:
-    return decode_state_msg(raw_packet)
-  
-  if raw_packet[1] == 0x02:
-    return decode_staterq_msg(raw_packet)
-
-  if raw_packet[1] == 0x04:
-    return decode_user_msg(raw_packet)
\ No newline at end of file
+  packets = parse_many((raw_packet,))
+  return packets[0] if packets else None
+
+#
+# Parse a batch of frames, skipping the ones that could not be decoded.
+# This is the hot path of the serial reader, so it works from DECODERS with local
+# names and checks the CRC with crc_hqx directly.
+def parse_many(frames):
+  if frames is None:
+    return []
+
+  packets = []
+  append = packets.append
+  decoders = DECODERS
+  for frame in frames:
+    size = len(frame)
+    if size < 2 or frame[0] != 0xAA:
+      continue
+    message_type = frame[1]
+    decoder = decoders.get(message_type)
+    if decoder is None:
+      continue
+    length, unpack_from, fields = decoder
+    if length is not None and size != length:
+      _wrong_length(message_type, frame)
+      continue
+    # Frames are short, slicing off the CRC is cheaper than a memoryview
+    valid = crc_hqx(frame[:-2], 0) == ((frame[-2] << 8) | frame[-1])
+    append(Packet(message_type, frame, fields, unpack_from(frame) if unpack_from is not None else (), valid))
+  return packets
@@ -0,0 +1,198 @@
+import os
+import time
+import mmap
+import logging
+from bisect import bisect_right
+from queue import Queue, Full, Empty
+from struct import Struct
+from threading import Thread
+
+#
+# Append-only flight recorder for raw serial frames.
+#
+# Frames are written to segment files named after the time they were opened:
+#   <directory>/<YYYYmmdd-HHMMSS>.seg
+# A segment starts with SEGMENT_MAGIC and is followed by records of
+#   receive timestamp (float64), source id (uint8), frame length (uint16), frame bytes
+# Next to every segment is a sparse index file (.seg.idx) of
+#   receive timestamp (float64), record offset (uint64)
+# entries, one every `index_interval` seconds, used to seek into a segment.
+# Whenever a new segment is started, the oldest segments and their indexes are deleted
+# until all of them together take at most `max_total_size` bytes.
+SEGMENT_MAGIC = b'KFSTSEG2'
+RECORD_HEADER = Struct('<dBH')
+INDEX_ENTRY = Struct('<dQ')
+
+log = logging.getLogger('recorder')
+
+class Recorder:
+  def __init__(self, directory, segment_size=64 * 1024 * 1024, index_interval=1.0, queue_size=10000,
+               max_total_size=1024 * 1024 * 1024):
+    self.directory = directory
+    self.segment_size = segment_size
+    self.max_total_size = max_total_size
+    self.index_interval = index_interval
+    self.q = Queue(queue_size)
+    # Frames that could not be recorded because the writer thread fell behind
+    self.dropped = 0
+    self.segment = None
+    self.index = None
+    self.last_indexed = None
+
+  def start(self):
+    os.makedirs(self.directory, exist_ok=True)
+    thread = Thread(target=self._write_loop)
+    thread.daemon = True
+    thread.start()
+
+  #
+  # Queues frames received from `source` at `timestamp` for writing. Never blocks the caller.
+  def record(self, frames, source=0, timestamp=None):
+    if not frames:
+      return
+    if timestamp is None:
+      timestamp = time.time()
+    try:
+      self.q.put_nowait((timestamp, source, frames))
+    except Full:
+      self.dropped += len(frames)
+
+  def _write_loop(self):
+    while True:
+      try:
+        timestamp, source, frames = self.q.get(timeout=1.0)
+      except Empty:
+        self._flush()
+        continue
+
+      try:
+        self._write(timestamp, source, frames)
+        if self.q.empty():
+          self._flush()
+      except Exception:
+        log.exception("failed to write frames")
+        self._close()
+
+  def _write(self, timestamp, source, frames):
+    if self.segment is None or self.segment.tell() >= self.segment_size:
+      self._open(timestamp)
+
+    if self.last_indexed is None or timestamp - self.last_indexed >= self.index_interval:
+      self.index.write(INDEX_ENTRY.pack(timestamp, self.segment.tell()))
+      self.last_indexed = timestamp
+
+    for frame in frames:
+      self.segment.write(RECORD_HEADER.pack(timestamp, source, len(frame)))
+      self.segment.write(frame)
+
+  def _open(self, timestamp):
+    self._close()
+    name = time.strftime('%Y%m%d-%H%M%S', time.localtime(timestamp))
+    path = os.path.join(self.directory, name + '.seg')
+    suffix = 1
+    while os.path.exists(path):
+      path = os.path.join(self.directory, '%s-%d.seg' % (name, suffix))
+      suffix += 1
+    log.info("writing segment", extra={'fields': {'path': path}})
+    self.segment = open(path, 'ab')
+    self.segment.write(SEGMENT_MAGIC)
+    self.index = open(path + '.idx', 'ab')
+    self.last_indexed = None
+    self._prune(path)
+
+  #
+  # Deletes the oldest segments other than `current` while all of them take more than max_total_size.
+  def _prune(self, current):
+    segments = []
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      if not name.endswith('.seg') or path == current:
+        continue
+      try:
+        stat = os.stat(path)
+        size = stat.st_size + (os.path.getsize(path + '.idx') if os.path.exists(path + '.idx') else 0)
+      except OSError:
+        continue
+      segments.append((stat.st_mtime, path, size))
+
+    total = sum(size for _, _, size in segments) + self.segment_size
+    for _, path, size in sorted(segments):
+      if total <= self.max_total_size:
+        break
+      log.info("deleting old segment", extra={'fields': {'path': path}})
+      for remove in (path, path + '.idx'):
+        try:
+          os.remove(remove)
+        except FileNotFoundError:
+          pass
+      total -= size
+
+  def _flush(self):
+    if self.segment is not None:
+      self.segment.flush()
+      self.index.flush()
+
+  def _close(self):
+    if self.segment is not None:
+      self.segment.close()
+      self.index.close()
+    self.segment = None
+    self.index = None
+
+#
+# A recorded segment, memory-mapped for reading.
+class Segment:
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if self.data[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+      raise ValueError('not a recorder segment: ' + path)
+    self.index_times, self.index_offsets = load_index(path + '.idx')
+
+  def close(self):
+    self.data.close()
+
+  # First recorded timestamp, or None for an empty segment
+  def start_time(self):
+    for timestamp, source, frame in self.records():
+      return timestamp
+    return None
+
+  #
+  # Returns the offset of a record at or before `timestamp`, using the sparse index.
+  def seek(self, timestamp):
+    i = bisect_right(self.index_times, timestamp) - 1
+    if i < 0:
+      return len(SEGMENT_MAGIC)
+    return self.index_offsets[i]
+
+  #
+  # Yields (timestamp, source, frame) for every record from `offset`, skipping records before `start`.
+  # A record cut short by a crash at the end of the segment is ignored.
+  def records(self, offset=None, start=None):
+    data = self.data
+    size = len(data)
+    if offset is None:
+      offset = len(SEGMENT_MAGIC)
+    while offset + RECORD_HEADER.size <= size:
+      timestamp, source, length = RECORD_HEADER.unpack_from(data, offset)
+      offset += RECORD_HEADER.size
+      if offset + length > size:
+        return
+      if start is None or timestamp >= start:
+        yield timestamp, source, data[offset:offset + length]
+      offset += length
+
+def load_index(path):
+  times = []
+  offsets = []
+  if not os.path.exists(path):
+    return times, offsets
+  with open(path, 'rb') as f:
+    data = f.read()
+  for i in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+    timestamp, offset = INDEX_ENTRY.unpack_from(data, i)
+    times.append(timestamp)
+    offsets.append(offset)
+  return times, offsets
@@ -1,144 +1,359 @@
+import os
 import time
 import serial
-import sys
-import traceback
+import logging
+import selectors
+from threading import Thread, Lock
 
-from packet_parser import parse_packet
+from packet_parser import parse_many, get_message_length, get_length_offset
+from crc import validate_frame
+from recorder import Segment
+import metrics
+
+log = logging.getLogger('serial_reader')
+
+BYTES_READ = metrics.counter('serial_bytes_read_total', 'Bytes read from the serial device')
+GARBAGE_BYTES = metrics.counter('serial_garbage_bytes_total', 'Bytes skipped while looking for the start of a frame')
+RESYNCS = metrics.counter('serial_resyncs_total', 'Times the framer skipped bytes to find the next frame')
+CRC_RESYNCS = metrics.counter('serial_crc_resyncs_total', 'Variable length frames whose end was found by CRC instead of their length byte')
+FRAMES = metrics.counter('serial_frames_total', 'Decoded frames by message type', ('type',))
+CRC_FAILURES = metrics.counter('serial_crc_failures_total', 'Decoded frames with a bad CRC by message type', ('type',))
+
+# Seconds to wait before reopening a serial device that failed
+RETRY_DELAY = 3
 
 #
-# Opens a serial port and starts listening to incoming data.
-def start_serial_listen(filename, baudrate, emit_packet, emit_status): 
-  if filename is None:
-    return
-  
-  if baudrate is None:
+# One serial device read by the multiplexer, tagged with the id of the source
+# it feeds. Each source has its own framer, so streams never mix mid-frame.
+class SerialSource:
+  def __init__(self, source_id, filename, baudrate):
+    self.id = source_id
+    self.filename = filename
+    self.baudrate = baudrate
+    self.framer = Framer()
+    self.ser = None
+    self.next_retry = 0
+
+  def open(self):
+    # timeout=0 makes reads return whatever is available without blocking
+    self.ser = serial.Serial(self.filename, baudrate=self.baudrate, timeout=0)
+    self.framer = Framer()
+
+  def close(self):
+    if self.ser is not None:
+      try:
+        self.ser.close()
+      except Exception:
+        pass
+    self.ser = None
+    self.next_retry = time.time() + RETRY_DELAY
+
+  def read(self):
+    return self.ser.read(max(self.ser.in_waiting, 1))
+
+#
+# Tells a running reader to stop. The reader watches the pipe in its selector,
+# so it stops right away instead of at the next select timeout.
+class StopSignal:
+  def __init__(self):
+    self.read_fd, self.write_fd = os.pipe()
+    self.stopped = False
+
+  def set(self):
+    self.stopped = True
+    os.write(self.write_fd, b'\0')
+
+  def is_set(self):
+    return self.stopped
+
+  def fileno(self):
+    return self.read_fd
+
+  def close(self):
+    os.close(self.read_fd)
+    os.close(self.write_fd)
+
+#
+# Reads any number of serial devices from one thread.
+#
+# The devices are registered with a selector and read as soon as they have data,
+# so every extra port costs nothing while it is quiet and a frame is framed the
+# moment its bytes are in the driver. With a `coalesce_delay` (seconds) the reader
+# waits that long after waking up before reading, to pick up more bytes per read
+# under heavy traffic. Devices that fail are closed and reopened after
+# RETRY_DELAY seconds without affecting the others.
+#
+# The reader runs until `stop` (a StopSignal) is set, then closes its devices.
+def start_multiplexed_listen(sources, emit_packet, emit_status, recorder=None, coalesce_delay=0, stop=None):
+  if not sources:
     return
-  
+
   if emit_packet is None:
     return
 
-  print("> serial reader: starting listen", filename, baudrate)
-  buffer = bytearray()
-  while True:
-    try:
-      with serial.Serial(filename, baudrate=baudrate, timeout=0.3) as ser:
-        emit_status('Serial connected')
-        print("> serial ready: name = ", ser.name)
-        while True:
-          read_bytes = ser.read(128)
-          for byte in read_bytes:
-            buffer.append(byte)
-          process_new_data(buffer, emit_packet)
-    except Exception as e:
-      emit_status('Error connecting to serial device ' + filename)
-      print("> serial reader: serial connection failed")
-      print(e)
-      ei = sys.exc_info()
-      print(traceback.print_tb(ei[2]))
-      time.sleep(3)
-
-def parse_packets(frames):
-  if frames is None:
-    return []
-  
-  packets = []
+  selector = selectors.DefaultSelector()
+  if stop is not None:
+    selector.register(stop, selectors.EVENT_READ, None)
+  while stop is None or not stop.is_set():
+    now = time.time()
+    for source in sources:
+      if source.ser is None and now >= source.next_retry:
+        _open_source(selector, source, emit_status)
+
+    timeout = 1.0
+    if all(source.ser is None for source in sources):
+      timeout = max(0.1, min(source.next_retry for source in sources) - now)
+      if stop is None:
+        time.sleep(timeout)
+        continue
 
-  for frame in frames:
-    packet = parse_packet(frame)
-    if packet is None:
-      continue
-    
-    packets.append(packet)
+    events = selector.select(timeout=timeout)
+    if events and coalesce_delay:
+      time.sleep(coalesce_delay)
 
-  return packets
+    for key, _ in events:
+      source = key.data
+      if source is None:
+        # The stop signal
+        continue
+      try:
+        data = source.read()
+      except Exception:
+        _close_source(selector, source, emit_status)
+        continue
+      process_new_data(source.framer, data, emit_packet, recorder, source.id, time.time())
 
+  for source in sources:
+    if source.ser is not None:
+      source.close()
+      emit_status('Serial device closed: ' + source.filename)
+  selector.close()
+  log.info("stopped listening", extra={'fields': {'sources': len(sources)}})
+
+def _open_source(selector, source, emit_status):
+  log.info("starting listen", extra={'fields': {'source': source.id, 'device': source.filename, 'baudrate': source.baudrate}})
+  try:
+    source.open()
+    selector.register(source.ser.fileno(), selectors.EVENT_READ, source)
+  except Exception:
+    emit_status('Error connecting to serial device ' + source.filename)
+    log.exception("serial connection failed", extra={'fields': {'source': source.id, 'device': source.filename}})
+    source.close()
+    return
+  emit_status('Serial connected: ' + source.filename)
+  log.info("serial ready", extra={'fields': {'source': source.id, 'name': source.ser.name}})
+
+def _close_source(selector, source, emit_status):
+  emit_status('Serial device disconnected: ' + source.filename)
+  log.exception("serial read failed", extra={'fields': {'source': source.id, 'device': source.filename}})
+  try:
+    selector.unregister(source.ser.fileno())
+  except Exception:
+    pass
+  source.close()
 
 #
 # Process new incoming bytes into packets and emit packets if needed
-def process_new_data(buffer, emit_packet):
-  if buffer is None:
+def process_new_data(framer, data, emit_packet, recorder=None, source=0, timestamp=None):
+  if framer is None:
     return
 
   if emit_packet is None:
     return
 
-  frames = split_into_frames(buffer)
-  packets = parse_packets(frames)
-  emit_packets(packets, emit_packet)
+  garbage = framer.garbage
+  resyncs = framer.resyncs
+  crc_resyncs = framer.crc_resyncs
+  frames = framer.feed(data)
+  BYTES_READ.inc(len(data))
+  if framer.garbage != garbage:
+    GARBAGE_BYTES.inc(framer.garbage - garbage)
+    RESYNCS.inc(framer.resyncs - resyncs)
+  if framer.crc_resyncs != crc_resyncs:
+    CRC_RESYNCS.inc(framer.crc_resyncs - crc_resyncs)
+
+  if recorder is not None:
+    recorder.record(frames, source, timestamp)
+  packets = parse_many(frames)
+  emit_packets(packets, emit_packet, source, timestamp)
 
 # 
 # Return how many bytes to take from the data buffer to compose a frame.
-# Return -1 to count until the next 0xAA with this frame.
+# Return -1 if the length is not known ahead of time - it is then read from the
+# frame's length byte or, for types without one, counted until the next 0xAA.
 #
 def get_frame_length(frame_type):
   if frame_type is None:
     return -1
 
-  if frame_type == 1:
-    return 24
-  if frame_type == 2:
-    return 5
-  if frame_type == 3:
-    return 10
-  return -1
+  length = get_message_length(frame_type)
+  if length is None:
+    return -1
+  return length
 
-def split_into_frames(buffer): 
+#
+# Incrementally splits a stream of serial bytes into frames.
+#
+# Incoming data is appended to a single buffer and frames are located with a
+# read cursor, so each byte is scanned once instead of once per frame. Sync
+# bytes are found with bytearray.find and consumed data is only dropped from
+# the front of the buffer once the cursor has moved far enough.
+#
+# Variable length frames (user messages) are cut at the length given by their
+# length byte. When that does not give a frame with a good CRC, the framer tries
+# the boundaries before each following 0xAA and the end of the data, and takes
+# the first one whose CRC matches. If none does, the 0xAA was not the start of a
+# frame and is skipped. A frame that is shorter than its length byte says is waited
+# for, unless a complete fixed length frame with a good CRC follows it, which means
+# its length byte was damaged.
+class Framer:
+  # Compact the buffer once this many consumed bytes have built up in front of the cursor
+  COMPACT_THRESHOLD = 4096
 
-  if buffer is None:
-    return []
-  
-  frames = []
+  def __init__(self):
+    self.buffer = bytearray()
+    self.pos = 0
+    # Total bytes taken out of the stream, both as frames and as garbage between frames
+    self.consumed = 0
+    self.garbage = 0
+    # Number of runs of garbage skipped
+    self.resyncs = 0
+    # Number of variable length frames whose end was found by CRC
+    self.crc_resyncs = 0
 
-  start = 0
-
-  # Find all frames in the data stream
-  while len(buffer) > 0:
-    # Find the start of a frame
-    while start < len(buffer) and (buffer[start] != 0xAA): 
-      start += 1
-    
-    # No frames detected yet
-    if start == len(buffer):
-      return frames
-
-    # Find the type of the frame
-    type_idx = start + 1
-    if type_idx == len(buffer):
-      return frames
-
-    # Figure out the length of the frame
-    frame_length = get_frame_length(buffer[type_idx])
-
-    # Special case: frame_length -1 specifies that frame length is not known ahead of time
-    if frame_length != -1:
-      # use predefined knowledge to find the end of the frame
-      if start + frame_length > len(buffer): 
-        print("> serial reader: frame data not yet fully collected in buffer")
-        print("> serial reader: frame data should be ", frame_length, " but is ", len(buffer) - start)
-        return frames
-      end = start + frame_length
-    else:
-      # let's scan for the end
-      end = start + 1
-      while end < len(buffer) and (buffer[end] != 0xAA):
-        end += 1
+  # Number of bytes received but not yet assigned to a frame
+  def pending(self):
+    return len(self.buffer) - self.pos
 
-      if end == len(buffer):
-        return frames
+  # Adds new bytes to the buffer and returns a list of all complete frames.
+  # If `offsets` is a list, the stream offset of every frame is appended to it.
+  def feed(self, data, offsets=None):
+    if data:
+      self.buffer += data
+    frames = []
+    self._split(frames, offsets)
+    self._compact()
+    return frames
 
-    raw_frame = buffer[start:end]
-    frames.append(raw_frame)
+  def _split(self, frames, offsets=None):
+    # Frames and CRC checks slice the view, which copies nothing. The buffer is
+    # only resized by feed and _compact, after the view is released.
+    with memoryview(self.buffer) as view:
+      self._split_view(view, frames, offsets)
 
-    # Delete any garbage before the read frame and the frame itself from read buffer
-    del buffer[0:end]
-    # Start again from the top
-    start = 0
-  
-  return frames
+  def _split_view(self, view, frames, offsets):
+    buffer = self.buffer
+    size = len(buffer)
+
+    while True:
+      # Find the start of a frame
+      start = buffer.find(0xAA, self.pos)
+      if start == -1:
+        # No frames detected - everything in the buffer is garbage
+        self._skip(size)
+        return
+      self._skip(start)
+
+      # Find the type of the frame
+      type_idx = start + 1
+      if type_idx == size:
+        return
+
+      # Figure out the length of the frame
+      frame_type = buffer[type_idx]
+      frame_length = get_frame_length(frame_type)
+
+      # Special case: frame_length -1 specifies that frame length is not known ahead of time
+      if frame_length != -1:
+        # use predefined knowledge to find the end of the frame
+        end = start + frame_length
+        if end > size:
+          return
+      elif get_length_offset(frame_type) is not None:
+        end = self._declared_end(view, start, get_length_offset(frame_type))
+        if end is None:
+          return
+        if end == -1:
+          # Nothing checks out - skip the sync byte and look for the next frame
+          self._skip(start + 1)
+          continue
+      else:
+        # let's scan for the end
+        end = buffer.find(0xAA, start + 1)
+        if end == -1:
+          return
+
+      frames.append(bytes(view[start:end]))
+      if offsets is not None:
+        offsets.append(self.consumed)
+      self.consumed += end - start
+      self.pos = end
+
+  #
+  # Finds the end of a frame starting at `start` with a length byte at `start + length_offset`.
+  # Returns None to wait for more data and -1 if no end with a matching CRC was found.
+  def _declared_end(self, view, start, length_offset):
+    buffer = self.buffer
+    size = len(buffer)
+    length_idx = start + length_offset
+    if length_idx >= size:
+      return None
+
+    end = length_idx + buffer[length_idx] + 2
+    if end <= size:
+      if validate_frame(view[start:end]):
+        return end
+    elif not self._complete_frame_after(view, start + 1):
+      # The rest of the frame has not arrived yet. A prefix of it can pass the CRC
+      # by chance, so only look for other ends once a later frame shows the length is wrong.
+      return None
+
+    # The length byte is wrong: try the boundaries before each following 0xAA, then the end of the data
+    limit = min(size, length_idx + 0xff + 2)
+    candidate = length_idx + 3
+    while candidate <= limit:
+      boundary = buffer.find(0xAA, candidate, limit)
+      if boundary == -1:
+        boundary = limit
+      if boundary != end and validate_frame(view[start:boundary]):
+        self.crc_resyncs += 1
+        return boundary
+      candidate = boundary + 1
+    return -1
+
+  # Whether a complete fixed length frame with a good CRC starts at or after `start`
+  def _complete_frame_after(self, view, start):
+    buffer = self.buffer
+    size = len(buffer)
+    candidate = buffer.find(0xAA, start)
+    while candidate != -1 and candidate + 1 < size:
+      frame_length = get_frame_length(buffer[candidate + 1])
+      if frame_length != -1 and candidate + frame_length <= size and validate_frame(view[candidate:candidate + frame_length]):
+        return True
+      candidate = buffer.find(0xAA, candidate + 1)
+    return False
+
+  # Marks the bytes up to `end` as garbage
+  def _skip(self, end):
+    skipped = end - self.pos
+    if skipped > 0:
+      self.garbage += skipped
+      self.resyncs += 1
+      self.consumed += skipped
+      self.pos = end
+
+  def _compact(self):
+    if self.pos == len(self.buffer):
+      self.buffer.clear()
+      self.pos = 0
+    elif self.pos >= self.COMPACT_THRESHOLD:
+      del self.buffer[:self.pos]
+      self.pos = 0
 
 
 # For each packet in read_packets, emits it to Socket.IO
-def emit_packets(packets, emit_packet):
+# `timestamp` is when the packets were read off the serial device, None for now
+def emit_packets(packets, emit_packet, source=0, timestamp=None):
   if packets is None:
     return
   
@@ -146,8 +361,98 @@ def emit_packets(packets, emit_packet):
     return
 
   for packet in packets:
-    emit_packet(packet.message_type, packet.raw, packet.parsed, packet.valid)
+    FRAMES.inc(1, packet.message_type)
+    if not packet.valid:
+      CRC_FAILURES.inc(1, packet.message_type)
+    emit_packet(packet.message_type, packet.raw, packet.values, packet.valid, source, timestamp)
+
+#
+# Reads the serial devices described by `devices`, a list of dicts with id, file and baudrate.
+def reader(devices, emit_packet, emit_status, recorder=None, coalesce_delay=0, stop=None):
+  log.info("init")
+  sources = [SerialSource(device['id'], device['file'], device['baudrate']) for device in devices]
+  start_multiplexed_listen(sources, emit_packet, emit_status, recorder, coalesce_delay, stop)
+
+#
+# Runs `reader` in a background thread that can be restarted with other devices
+# while the rest of the server keeps running.
+class ReaderThread:
+  def __init__(self, emit_packet, emit_status, recorder=None):
+    self.emit_packet = emit_packet
+    self.emit_status = emit_status
+    self.recorder = recorder
+    self.thread = None
+    self.stop_signal = None
+    self.lock = Lock()
+
+  def start(self, devices, coalesce_delay=0):
+    with self.lock:
+      self._start(devices, coalesce_delay)
+
+  # Stops the running reader and waits up to `timeout` seconds for it to close its devices
+  def stop(self, timeout=5):
+    with self.lock:
+      self._stop(timeout)
+
+  def restart(self, devices, coalesce_delay=0, timeout=5):
+    with self.lock:
+      self._stop(timeout)
+      self._start(devices, coalesce_delay)
+
+  def _start(self, devices, coalesce_delay):
+    self.stop_signal = StopSignal()
+    self.thread = Thread(target=reader, args=(devices, self.emit_packet, self.emit_status, self.recorder,
+                                              coalesce_delay, self.stop_signal))
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _stop(self, timeout):
+    if self.thread is None:
+      return
+    self.stop_signal.set()
+    self.thread.join(timeout)
+    if self.thread.is_alive():
+      log.warning("reader did not stop in time", extra={'fields': {'timeout': timeout}})
+    else:
+      self.stop_signal.close()
+    self.thread = None
+    self.stop_signal = None
+
+# How many frames to parse and emit at once when replaying as fast as possible
+REPLAY_BATCH = 256
+
+#
+# Replays a recorded segment through the packet parser, at `speed` times real time.
+# A speed of 0 replays as fast as possible. `skip` seconds are skipped from the start of the recording.
+def replay(filename, speed, emit_packet, emit_status, skip=0):
+  log.info("replaying", extra={'fields': {'file': filename, 'speed': speed}})
+  segment = Segment(filename)
+  first = segment.start_time()
+  if first is None:
+    emit_status('Recording is empty: ' + filename)
+    return
+
+  emit_status('Replaying ' + filename)
+  start = first + skip
+  started = time.time()
+  frames = []
+  frames_source = None
+  frames_time = None
+  for timestamp, source, frame in segment.records(segment.seek(start), start):
+    if speed > 0:
+      delay = (timestamp - start) / speed - (time.time() - started)
+      if delay > 0:
+        emit_packets(parse_many(frames), emit_packet, frames_source, frames_time)
+        frames = []
+        time.sleep(delay)
+    # Frames are emitted with their recorded receive time, so batches never mix reads
+    if source != frames_source or timestamp != frames_time or len(frames) >= REPLAY_BATCH:
+      emit_packets(parse_many(frames), emit_packet, frames_source, frames_time)
+      frames = []
+      frames_source = source
+      frames_time = timestamp
+    frames.append(frame)
 
-def reader(serial_device, baudrate, emit_packet, emit_status):
-  print("> serial reader: init")
-  start_serial_listen(serial_device, baudrate, emit_packet, emit_status)
+  emit_packets(parse_many(frames), emit_packet, frames_source, frames_time)
+  segment.close()
+  emit_status('Replay finished')
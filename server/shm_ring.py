@@ -0,0 +1,227 @@
+import time
+import logging
+from struct import Struct
+from threading import Lock
+from multiprocessing import shared_memory, resource_tracker
+
+from recorder import RECORD_HEADER
+from packet_parser import parse_packet
+import metrics
+
+log = logging.getLogger('shm_ring')
+
+RECORDS_WRITTEN = metrics.counter('ring_records_written_total', 'Frames and status messages written into the shared ring')
+RECORDS_TOO_LARGE = metrics.counter('ring_records_too_large_total', 'Frames not written into the shared ring because they did not fit a slot')
+RECORDS_LOST = metrics.counter('ring_records_lost_total', 'Records overwritten in the shared ring before this process read them')
+
+#
+# A ring buffer of raw frames in shared memory, written by one ingest process and
+# read by any number of web worker processes.
+#
+# The ring is a header followed by `slots` fixed-size slots. Every record gets the
+# next sequence number and goes into slot `seq % slots`:
+#   header: magic, slot count (uint32), slot size (uint32), last written sequence number (uint64),
+#     generation (uint64)
+#   slot: sequence number (uint64), then a recorder record header and the frame
+# The writer zeroes a slot's sequence number before filling it and sets it after,
+# so a reader that finds a different sequence number after copying a record out
+# knows it was overwritten and counts it as lost. Readers keep their own position
+# and never block the writer, so a slow reader only ever loses its own records.
+# A restarted ingest process replaces the ring with a new one with a new generation,
+# the start time of the process in microseconds. Readers that are idle check the
+# generation of the ring under the name and attach to the new one when it changed.
+RING_MAGIC = b'KFSTRNG1'
+RING_HEADER = Struct('<8sIIQQ')
+# Slots start at this offset, past the header
+SLOTS_OFFSET = 64
+# Index of the last written sequence number in the header, in 8 byte words
+WRITE_SEQ = 2
+# Index of the generation in the header, in 8 byte words
+GENERATION = 3
+# Status messages are stored as records starting with this byte, frames always start with 0xAA
+STATUS_PREFIX = b'\0'
+
+class SharedRing:
+  def __init__(self, shm, slots, slot_size, owner):
+    self.shm = shm
+    self.buf = shm.buf
+    self.slots = slots
+    self.slot_size = slot_size
+    self.owner = owner
+    self.name = shm.name
+    # The sequence numbers as 8 byte words
+    self.words = shm.buf.cast('Q')
+    self.max_record = slot_size - 8 - RECORD_HEADER.size
+    self.lock = Lock()
+
+  #
+  # Creates the ring for the ingest process, replacing a ring left behind by an earlier run.
+  @classmethod
+  def create(cls, name, slots=16384, slot_size=288):
+    slot_size = (slot_size + 7) // 8 * 8
+    size = SLOTS_OFFSET + slots * slot_size
+    try:
+      stale = shared_memory.SharedMemory(name)
+      stale.close()
+      stale.unlink()
+    except FileNotFoundError:
+      pass
+    shm = shared_memory.SharedMemory(name, create=True, size=size)
+    RING_HEADER.pack_into(shm.buf, 0, RING_MAGIC, slots, slot_size, 0, int(time.time() * 1000000))
+    return cls(shm, slots, slot_size, True)
+
+  #
+  # Opens the ring of a running ingest process.
+  @classmethod
+  def attach(cls, name):
+    shm = shared_memory.SharedMemory(name)
+    # Only the process that created the ring may remove it
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    magic, slots, slot_size, _, _ = RING_HEADER.unpack_from(shm.buf, 0)
+    if magic != RING_MAGIC:
+      shm.close()
+      raise ValueError('not a frame ring: ' + name)
+    return cls(shm, slots, slot_size, False)
+
+  def close(self):
+    self.words.release()
+    self.buf = None
+    self.shm.close()
+    if self.owner:
+      self.shm.unlink()
+
+  def write_seq(self):
+    return self.words[WRITE_SEQ]
+
+  def generation(self):
+    return self.words[GENERATION]
+
+  # The oldest sequence number still in the ring
+  def oldest_seq(self):
+    return max(1, self.write_seq() - self.slots + 1)
+
+  def _slot(self, seq):
+    return SLOTS_OFFSET + (seq % self.slots) * self.slot_size
+
+  def write(self, timestamp, source, record):
+    if len(record) > self.max_record:
+      RECORDS_TOO_LARGE.inc()
+      return
+    with self.lock:
+      seq = self.words[WRITE_SEQ] + 1
+      offset = self._slot(seq)
+      self.words[offset // 8] = 0
+      RECORD_HEADER.pack_into(self.buf, offset + 8, timestamp, source, len(record))
+      start = offset + 8 + RECORD_HEADER.size
+      self.buf[start:start + len(record)] = record
+      self.words[offset // 8] = seq
+      self.words[WRITE_SEQ] = seq
+    RECORDS_WRITTEN.inc()
+
+  #
+  # Reads up to `max_records` records from sequence number `seq` on.
+  # Returns the records as (seq, timestamp, source, record), the next sequence number
+  # to read and the number of records that were overwritten before they could be read.
+  def read(self, seq, max_records=256):
+    last = self.words[WRITE_SEQ]
+    lost = 0
+    # Records more than a ring behind have been overwritten already
+    oldest = last - self.slots + 1
+    if seq < oldest:
+      lost += oldest - seq
+      seq = oldest
+
+    records = []
+    end = min(last, seq + max_records - 1)
+    while seq <= end:
+      offset = self._slot(seq)
+      word = offset // 8
+      if self.words[word] != seq:
+        lost += 1
+        seq += 1
+        continue
+      timestamp, source, length = RECORD_HEADER.unpack_from(self.buf, offset + 8)
+      start = offset + 8 + RECORD_HEADER.size
+      record = bytes(self.buf[start:start + min(length, self.max_record)])
+      if self.words[word] != seq:
+        lost += 1
+      else:
+        records.append((seq, timestamp, source, record))
+      seq += 1
+
+    if lost:
+      RECORDS_LOST.inc(lost)
+    return records, seq, lost
+
+#
+# The emit_packet and emit_status callbacks of the serial reader for the ingest process.
+def make_ring_sinks(ring):
+  def emit_packet(message_type, raw, values=(), valid=True, source=0, timestamp=None):
+    ring.write(timestamp if timestamp is not None else time.time(), source, raw)
+
+  def emit_status(status, details=None):
+    text = status if details is None else status + ': ' + details
+    ring.write(time.time(), 0, STATUS_PREFIX + text.encode('utf-8'))
+
+  return emit_packet, emit_status
+
+#
+# The generation of the ring currently under `name`, None if there is none.
+def current_generation(name):
+  try:
+    shm = shared_memory.SharedMemory(name)
+  except FileNotFoundError:
+    return None
+  resource_tracker.unregister(shm._name, 'shared_memory')
+  try:
+    magic, _, _, _, generation = RING_HEADER.unpack_from(shm.buf, 0)
+    return generation if magic == RING_MAGIC else None
+  finally:
+    shm.close()
+
+#
+# Follows the ring from its current end and hands every frame to `emit_packet`,
+# the same way the serial reader does, for a web worker process.
+# Frames are parsed again here, which is cheaper than passing the decoded fields between processes.
+# While the ring is idle the poll interval doubles from `poll_interval` up to `max_poll_interval`,
+# and drops back as soon as a frame arrives.
+# When idle, checks every `check_interval` seconds whether the ingest process was restarted
+# and moves on to its new ring.
+def follow(ring, emit_packet, emit_status, poll_interval=0.002, check_interval=1.0, max_poll_interval=0.05):
+  log.info("following ring", extra={'fields': {'slots': ring.slots, 'slot_size': ring.slot_size}})
+  seq = ring.write_seq() + 1
+  last_check = time.time()
+  sleep = poll_interval
+  while True:
+    records, seq, lost = ring.read(seq)
+    if lost:
+      emit_status('Fell behind the ingest process, %d messages skipped' % lost)
+    for _, timestamp, source, record in records:
+      if record[:1] == STATUS_PREFIX:
+        emit_status(record[1:].decode('utf-8', 'replace'))
+        continue
+      packet = parse_packet(record)
+      if packet is not None:
+        emit_packet(packet.message_type, packet.raw, packet.values, packet.valid, source, timestamp)
+    if records:
+      sleep = poll_interval
+      continue
+
+    if time.time() - last_check >= check_interval:
+      last_check = time.time()
+      generation = current_generation(ring.name)
+      if generation is not None and generation != ring.generation():
+        try:
+          new_ring = SharedRing.attach(ring.name)
+        except (FileNotFoundError, ValueError):
+          continue
+        ring.close()
+        ring = new_ring
+        # Everything the new ingest process wrote so far, unless it has wrapped around already
+        seq = ring.oldest_seq()
+        log.info("ingest process restarted, following its new ring", extra={'fields': {'generation': generation}})
+        emit_status('Ingest process restarted')
+        sleep = poll_interval
+        continue
+    time.sleep(sleep)
+    sleep = min(sleep * 2, max_poll_interval)
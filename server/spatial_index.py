@@ -0,0 +1,188 @@
+import math
+import time
+from array import array
+from threading import Lock
+
+#
+# A grid index over the 0x01 positions of every node, for "what was in this area
+# during this interval" queries at the resolution of the current zoom.
+#
+# Positions are kept in time buckets of `bucket_seconds`. In every bucket they are
+# stored in a pyramid of square grids: level 0 keeps every point in cells of
+# `cell_size`, and each level above averages the points of a node into cells twice
+# as wide, so a zoomed out view gets one point per node and cell instead of every
+# sample. A query only visits the buckets in its time window and the cells in its
+# bounding box, and picks the finest level whose result fits a point budget.
+# Buckets older than `retention` seconds are dropped.
+
+class Bucket:
+  def __init__(self, levels):
+    # Level 0: (cx, cy) -> flat array of node, t, x, y
+    self.points = {}
+    # Levels 1 and up: (cx, cy) -> {node: [count, sum_x, sum_y, last_t]}
+    self.cells = [{} for _ in range(levels - 1)]
+
+class TrajectoryIndex:
+  def __init__(self, cell_size=5.0, levels=10, bucket_seconds=60, retention=12 * 3600):
+    self.cell_size = cell_size
+    self.levels = levels
+    self.bucket_seconds = bucket_seconds
+    self.retention = retention
+    self.buckets = {}
+    self.lock = Lock()
+
+  def level_size(self, level):
+    return self.cell_size * (1 << level)
+
+  #
+  # Adds a position of `node`. Called from the serial reader thread.
+  def add(self, node, x, y, timestamp=None):
+    if timestamp is None:
+      timestamp = time.time()
+    if not (math.isfinite(x) and math.isfinite(y)):
+      return
+    bucket_id = int(timestamp // self.bucket_seconds)
+    cx = math.floor(x / self.cell_size)
+    cy = math.floor(y / self.cell_size)
+
+    with self.lock:
+      bucket = self.buckets.get(bucket_id)
+      if bucket is None:
+        bucket = self.buckets[bucket_id] = Bucket(self.levels)
+        self._evict(bucket_id)
+
+      points = bucket.points.get((cx, cy))
+      if points is None:
+        points = bucket.points[(cx, cy)] = array('d')
+      points.extend((node, timestamp, x, y))
+
+      for level, cells in enumerate(bucket.cells, 1):
+        key = (cx >> level, cy >> level)
+        nodes = cells.get(key)
+        if nodes is None:
+          nodes = cells[key] = {}
+        cell = nodes.get(node)
+        if cell is None:
+          nodes[node] = [1, x, y, timestamp]
+        else:
+          cell[0] += 1
+          cell[1] += x
+          cell[2] += y
+          cell[3] = timestamp
+
+  def _evict(self, newest):
+    oldest = newest - int(self.retention // self.bucket_seconds)
+    for bucket_id in [b for b in self.buckets if b < oldest]:
+      del self.buckets[bucket_id]
+
+  #
+  # The coarsest level whose cells are at most `resolution` wide
+  def level_for(self, resolution):
+    if resolution <= self.cell_size:
+      return 0
+    return min(self.levels - 1, int(math.log2(resolution / self.cell_size)))
+
+  #
+  # Yields the entries of the grids at `level` inside `bbox` in the buckets between `start` and `end`.
+  # Must be called with the lock held.
+  def _entries(self, bbox, start, end, level):
+    x0, y0, x1, y1 = bbox
+    size = self.level_size(level)
+    cx0, cy0 = math.floor(x0 / size), math.floor(y0 / size)
+    cx1, cy1 = math.floor(x1 / size), math.floor(y1 / size)
+    first = None if start is None else int(start // self.bucket_seconds)
+    last = None if end is None else int(end // self.bucket_seconds)
+
+    for bucket_id, bucket in self.buckets.items():
+      if (first is not None and bucket_id < first) or (last is not None and bucket_id > last):
+        continue
+      grid = bucket.points if level == 0 else bucket.cells[level - 1]
+      for key in self._keys(grid, cx0, cy0, cx1, cy1):
+        entry = grid.get(key)
+        if entry is not None:
+          yield key, entry
+
+  #
+  # An upper bound of the number of points `query` would return, without building them
+  def estimate(self, bbox, start=None, end=None, level=0):
+    with self.lock:
+      if level == 0:
+        return sum(len(points) // 4 for _, points in self._entries(bbox, start, end, level))
+      return len({(key, node) for key, cells in self._entries(bbox, start, end, level) for node in cells})
+
+  #
+  # Returns the positions in `bbox` (x0, y0, x1, y1) between `start` and `end` at `level`,
+  # as {node: {'t': [], 'x': [], 'y': [], 'n': []}} sorted by time.
+  #
+  # Level 0 returns every sample. Higher levels return one point per node and cell for the
+  # whole time window: the average position of the `n` samples in it, at the time of the
+  # last one. These are matched to the time window by their time bucket, so they can
+  # include samples up to a bucket outside of it.
+  def query(self, bbox, start=None, end=None, level=0, nodes=None):
+    found = {}
+    merged = {}
+    with self.lock:
+      for key, entry in self._entries(bbox, start, end, level):
+        if level == 0:
+          self._collect_points(found, entry, bbox, start, end, nodes)
+        else:
+          self._merge_cells(merged, key, entry, nodes)
+
+    x0, y0, x1, y1 = bbox
+    for (node, _), (count, sum_x, sum_y, last_t) in merged.items():
+      x = sum_x / count
+      y = sum_y / count
+      if x0 <= x <= x1 and y0 <= y <= y1:
+        found.setdefault(node, []).append((last_t, x, y, count))
+
+    result = {}
+    for node, samples in found.items():
+      samples.sort()
+      result[str(node)] = {
+        't': [s[0] for s in samples],
+        'x': [round(s[1], 3) for s in samples],
+        'y': [round(s[2], 3) for s in samples],
+        'n': [s[3] for s in samples],
+      }
+    return result
+
+  # The cells of `grid` to look at: every cell in the box, or every cell of the grid if there are fewer
+  def _keys(self, grid, cx0, cy0, cx1, cy1):
+    if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) <= len(grid):
+      return [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)]
+    return [(cx, cy) for cx, cy in grid if cx0 <= cx <= cx1 and cy0 <= cy <= cy1]
+
+  def _collect_points(self, found, points, bbox, start, end, nodes):
+    x0, y0, x1, y1 = bbox
+    for i in range(0, len(points), 4):
+      node = int(points[i])
+      t, x, y = points[i + 1], points[i + 2], points[i + 3]
+      if nodes is not None and node not in nodes:
+        continue
+      if (start is not None and t < start) or (end is not None and t > end):
+        continue
+      if x0 <= x <= x1 and y0 <= y <= y1:
+        found.setdefault(node, []).append((t, x, y, 1))
+
+  # Adds up the cells of the same node and grid cell over all time buckets
+  def _merge_cells(self, merged, key, cells, nodes):
+    for node, (count, sum_x, sum_y, last_t) in cells.items():
+      if nodes is not None and node not in nodes:
+        continue
+      total = merged.get((node, key))
+      if total is None:
+        merged[(node, key)] = [count, sum_x, sum_y, last_t]
+      else:
+        total[0] += count
+        total[1] += sum_x
+        total[2] += sum_y
+        total[3] = max(total[3], last_t)
+
+  #
+  # Picks the finest level with cells of at least `resolution` whose result has at most
+  # `max_points` points, and returns the level and the query result.
+  def query_view(self, bbox, start=None, end=None, resolution=0.0, max_points=5000, nodes=None):
+    level = self.level_for(resolution)
+    while level < self.levels - 1 and self.estimate(bbox, start, end, level) > max_points:
+      level += 1
+    return level, self.query(bbox, start, end, level, nodes)
@@ -0,0 +1,138 @@
+import os
+import re
+import sys
+import gzip
+import hashlib
+import mimetypes
+from io import BytesIO
+from inspect import signature
+
+from flask import request, send_file, abort, make_response
+from werkzeug.security import safe_join
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+#
+# Serves the frontend build with precompressed variants and cache headers.
+#
+# `precompress` writes a .gz (and a .br when the brotli module is installed) next
+# to every text asset at image build time, so nothing is compressed while serving.
+# Every response carries a strong ETag of the bytes sent and conditional requests
+# are answered with 304. Assets with a content hash in their name, like the
+# bundles under static/js, never change and are cached as immutable; everything
+# else, like index.html, is revalidated on every load.
+
+# Extensions worth compressing
+COMPRESSIBLE = ('.html', '.js', '.css', '.json', '.map', '.svg', '.txt', '.ico')
+# Files smaller than this are not compressed
+MIN_SIZE = 256
+# Content encodings in order of preference, with the suffix of their variant
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# e.g. main.1f2e3d4c.chunk.js
+HASHED_NAME = re.compile(r'\.[0-9a-f]{8,}\.(chunk\.)?[a-z0-9]+$')
+CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
+CACHE_REVALIDATE = 'no-cache'
+
+# Flask 2.0 renamed the caching arguments of send_file; the image's Python 3.5 only gets Flask 1.x
+if 'max_age' in signature(send_file).parameters:
+  SEND_FILE_ARGS = {'conditional': False, 'etag': False, 'max_age': None}
+else:
+  SEND_FILE_ARGS = {'conditional': False, 'add_etags': False, 'cache_timeout': None}
+
+def _compress(data, encoding):
+  if encoding == 'br':
+    return brotli.compress(data, quality=11)
+  # A fixed mtime keeps the output the same for the same input
+  out = BytesIO()
+  with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9, mtime=0) as f:
+    f.write(data)
+  return out.getvalue()
+
+#
+# Writes the compressed variants of every compressible file under `directory`.
+# Variants that come out no smaller than the original are left out.
+# Returns the number of files written.
+def precompress(directory):
+  written = 0
+  encodings = [(encoding, suffix) for encoding, suffix in ENCODINGS if encoding != 'br' or brotli is not None]
+  for root, _, files in os.walk(directory):
+    for name in files:
+      if not name.endswith(COMPRESSIBLE):
+        continue
+      path = os.path.join(root, name)
+      with open(path, 'rb') as f:
+        data = f.read()
+      if len(data) < MIN_SIZE:
+        continue
+      for encoding, suffix in encodings:
+        compressed = _compress(data, encoding)
+        if len(compressed) >= len(data):
+          continue
+        with open(path + suffix, 'wb') as f:
+          f.write(compressed)
+        written += 1
+  return written
+
+class StaticFiles:
+  def __init__(self, directory):
+    self.directory = directory
+    # path -> (mtime, size, etag)
+    self.etags = {}
+
+  # A strong ETag of the file contents, computed once per version of the file
+  def etag(self, path, stat):
+    cached = self.etags.get(path)
+    if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+      return cached[2]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(65536), b''):
+        digest.update(block)
+    etag = digest.hexdigest()[:20]
+    self.etags[path] = (stat.st_mtime_ns, stat.st_size, etag)
+    return etag
+
+  # The precompressed variant the client accepts, if there is an up to date one
+  def _variant(self, path, stat):
+    accepted = request.accept_encodings
+    for encoding, suffix in ENCODINGS:
+      if not accepted[encoding]:
+        continue
+      try:
+        variant_stat = os.stat(path + suffix)
+      except OSError:
+        continue
+      if variant_stat.st_mtime_ns >= stat.st_mtime_ns:
+        return encoding, path + suffix, variant_stat
+    return None, path, stat
+
+  def serve(self, filename):
+    path = safe_join(self.directory, filename)
+    if path is None or not os.path.isfile(path):
+      abort(404)
+
+    encoding, served, stat = self._variant(path, os.stat(path))
+    etag = self.etag(served, stat)
+    if request.if_none_match.contains(etag):
+      response = make_response('', 304)
+    else:
+      mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+      response = send_file(served, mimetype=mimetype, **SEND_FILE_ARGS)
+      # send_file names the variant, which would be the .gz file
+      response.headers.pop('Content-Disposition', None)
+      if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = CACHE_IMMUTABLE if HASHED_NAME.search(filename) else CACHE_REVALIDATE
+    return response
+
+if __name__ == '__main__':
+  # Run at image build time: python3 server/static_files.py server/static
+  directory = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), 'static')
+  print("precompressed %d files in %s" % (precompress(directory), directory))
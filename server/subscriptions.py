@@ -0,0 +1,115 @@
+from collections import namedtuple
+
+from wire import FORMATS, FORMAT_JSON
+
+#
+# What a Socket.IO client wants to receive.
+#   format: wire format, see wire.py
+#   types: serial message types to send, None for all
+#   nodes: node ids to send, None for all
+#   mode: MODE_FULL sends every message, MODE_LATEST sends state (0x01) messages
+#         conflated to the newest one per node, at most `rate` times per second
+#
+# Clients with the same subscription share a Socket.IO room, so every batch is
+# filtered and encoded once per distinct subscription instead of once per client.
+MODE_FULL = 'full'
+MODE_LATEST = 'latest'
+MODES = (MODE_FULL, MODE_LATEST)
+
+class Subscription(namedtuple('Subscription', ['format', 'types', 'nodes', 'mode', 'rate'])):
+  __slots__ = ()
+
+  @property
+  def room(self):
+    return 'sub:%s:%s:%s:%s:%s' % (
+      self.format,
+      ','.join(map(str, sorted(self.types))) if self.types is not None else '*',
+      ','.join(map(str, sorted(self.nodes))) if self.nodes is not None else '*',
+      self.mode,
+      self.rate
+    )
+
+  # Status messages go to everyone, serial messages are filtered by type and node
+  def matches(self, message):
+    if message['type'] != 'serial':
+      return True
+    if self.types is not None and message['msg'] not in self.types:
+      return False
+    if self.nodes is not None and message.get('node') not in self.nodes:
+      return False
+    return True
+
+  # Whether state messages are sent by the conflation loop instead of in batches
+  def conflates(self, message):
+    return self.mode == MODE_LATEST and message['type'] == 'serial' and message['msg'] == 0x01
+
+DEFAULT_SUBSCRIPTION = Subscription(FORMAT_JSON, None, None, MODE_FULL, 0)
+
+def _int_set(values):
+  if values is None:
+    return None
+  if not isinstance(values, (list, tuple)):
+    raise ValueError('expected a list of integers')
+  return frozenset(int(value) for value in values)
+
+#
+# Builds a subscription from a `subscribe` event, falling back to `current` for missing keys.
+# Raises ValueError on invalid input. The rate is capped at `max_rate`.
+def parse_subscription(data, current=DEFAULT_SUBSCRIPTION, max_rate=10):
+  if not isinstance(data, dict):
+    raise ValueError('subscription must be an object')
+
+  fmt = data.get('format', current.format)
+  if fmt not in FORMATS:
+    raise ValueError('unknown format: %s' % fmt)
+
+  mode = data.get('mode', current.mode)
+  if mode not in MODES:
+    raise ValueError('unknown mode: %s' % mode)
+
+  rate = 0
+  if mode == MODE_LATEST:
+    rate = min(float(data.get('rate', current.rate or max_rate)), max_rate)
+    if rate <= 0:
+      raise ValueError('rate must be positive')
+
+  types = _int_set(data['types']) if 'types' in data else current.types
+  nodes = _int_set(data['nodes']) if 'nodes' in data else current.nodes
+  return Subscription(fmt, types, nodes, mode, rate)
+
+#
+# Keeps track of the subscription of each connected client.
+class Subscriptions:
+  def __init__(self):
+    self.clients = {}
+
+  def get(self, sid):
+    return self.clients.get(sid, DEFAULT_SUBSCRIPTION)
+
+  def set(self, sid, subscription):
+    self.clients[sid] = subscription
+
+  def remove(self, sid):
+    self.clients.pop(sid, None)
+
+  # Distinct subscriptions that have at least one client
+  def active(self):
+    return set(self.clients.values())
+
+#
+# Holds the newest state message of every node for MODE_LATEST subscriptions.
+# Each update gets an increasing version so every room can tell what it has not seen yet.
+class Conflator:
+  def __init__(self):
+    self.latest = {}
+    self.version = 0
+
+  def update(self, messages):
+    for message in messages:
+      if message['type'] == 'serial' and message['msg'] == 0x01:
+        self.version += 1
+        self.latest[message.get('node')] = (self.version, message)
+
+  # State messages newer than `version` that match the subscription
+  def since(self, version, subscription):
+    return [message for v, message in self.latest.values() if v > version and subscription.matches(message)]
@@ -0,0 +1,148 @@
+import math
+import random
+from bisect import bisect
+from itertools import accumulate
+from struct import Struct
+
+from crc import crc16xmodem
+
+#
+# Synthetic serial traffic for benchmarks and load tests.
+#
+# Frames are built with the same layout the packet parser decodes (see MESSAGE_FORMATS
+# in packet_parser.py), followed by a big-endian CRC16-XMODEM of the frame.
+STATE_PAYLOAD = Struct('<BB5f')
+STATERQ_PAYLOAD = Struct('<BBB')
+CONTROL_PAYLOAD = Struct('<BBBBf')
+
+# Default share of each message type in a generated stream
+DEFAULT_MIX = {0x01: 0.7, 0x02: 0.15, 0x03: 0.1, 0x04: 0.05}
+
+def with_crc(body):
+  crc = crc16xmodem(body)
+  return body + bytes(((crc >> 8) & 0xff, crc & 0xff))
+
+def state_frame(x, y, phi, sp_x, sp_y):
+  return with_crc(STATE_PAYLOAD.pack(0xAA, 0x01, x, y, phi, sp_x, sp_y))
+
+def staterq_frame(node_id):
+  return with_crc(STATERQ_PAYLOAD.pack(0xAA, 0x02, node_id))
+
+def control_frame(node_id, control_type, u):
+  return with_crc(CONTROL_PAYLOAD.pack(0xAA, 0x03, node_id, control_type, u))
+
+#
+# User messages as seen in recordings: 0xAA 0x04, a header byte, a length byte
+# counting itself and the payload, the payload and the CRC.
+def user_frame(payload, header=0xAA):
+  return with_crc(bytes((0xAA, 0x04, header, len(payload) + 1)) + payload)
+
+#
+# A boat driving in a circle, producing state messages.
+class SimulatedBoat:
+  def __init__(self, node_id, radius=20.0, speed=0.05, rng=None):
+    self.node_id = node_id
+    self.radius = radius
+    self.speed = speed
+    self.angle = 0.0
+    self.rng = rng or random.Random()
+    self.center = (self.rng.uniform(-100, 100), self.rng.uniform(-100, 100))
+
+  def step(self, noise=0.0):
+    self.angle += self.speed
+    x = self.center[0] + self.radius * math.cos(self.angle)
+    y = self.center[1] + self.radius * math.sin(self.angle)
+    if noise:
+      x += self.rng.gauss(0, noise)
+      y += self.rng.gauss(0, noise)
+    phi = math.degrees(self.angle) + 90
+    return state_frame(x, y, phi, self.center[0], self.center[1])
+
+#
+# Damages a frame the way a noisy radio link does: a flipped bit (never into a new
+# 0xAA) with chance `crc_errors`, and cut short with chance `truncated`.
+# Returns the frame and whether it was corrupted and truncated.
+def corrupt_frame(frame, rng, crc_errors=0.0, truncated=0.0):
+  corrupted = False
+  if crc_errors and rng.random() < crc_errors:
+    frame = bytearray(frame)
+    i = rng.randrange(2, len(frame))
+    frame[i] ^= 1 << rng.randrange(8)
+    if frame[i] == 0xAA:
+      frame[i] ^= 0x01
+    frame = bytes(frame)
+    corrupted = True
+
+  cut = False
+  if truncated and rng.random() < truncated:
+    frame = frame[:rng.randrange(2, len(frame))]
+    cut = True
+  return frame, corrupted, cut
+
+# Random bytes between frames, never containing 0xAA
+def garbage_bytes(rng):
+  return bytes(rng.randrange(0xAA) for _ in range(rng.randrange(1, 16)))
+
+#
+# Counts of what went into a generated stream.
+class StreamStats:
+  def __init__(self):
+    self.frames = {0x01: 0, 0x02: 0, 0x03: 0, 0x04: 0}
+    self.garbage_bytes = 0
+    self.truncated = 0
+    self.crc_errors = 0
+
+  def as_dict(self):
+    return {
+      'frames': {str(k): v for k, v in self.frames.items()},
+      'garbage_bytes': self.garbage_bytes,
+      'truncated': self.truncated,
+      'crc_errors': self.crc_errors,
+    }
+
+#
+# Generates `count` frames of traffic for `boats` simulated boats.
+#   mix: share of each message type
+#   garbage: chance of random non-0xAA bytes between frames
+#   truncated: chance of a frame being cut short
+#   crc_errors: chance of a bit flip in a frame
+# Returns the stream as bytes and its StreamStats.
+def generate_stream(count, mix=None, boats=1, garbage=0.0, truncated=0.0, crc_errors=0.0, noise=0.0, seed=None):
+  rng = random.Random(seed)
+  mix = mix or DEFAULT_MIX
+  types = list(mix)
+  # Drawn like random.choices, which needs Python 3.6
+  cum_weights = list(accumulate(mix[t] for t in types))
+  total = cum_weights[-1]
+  fleet = [SimulatedBoat(node_id, rng=rng) for node_id in range(1, boats + 1)]
+  stats = StreamStats()
+  out = bytearray()
+
+  message_types = [types[bisect(cum_weights, rng.random() * total, 0, len(types) - 1)] for _ in range(count)]
+  for message_type in message_types:
+    boat = rng.choice(fleet)
+    if message_type == 0x01:
+      frame = boat.step(noise)
+    elif message_type == 0x02:
+      frame = staterq_frame(boat.node_id)
+    elif message_type == 0x03:
+      frame = control_frame(boat.node_id, rng.randrange(4), rng.uniform(-1, 1))
+    else:
+      frame = user_frame(bytes(rng.randrange(0xAA) for _ in range(rng.randrange(1, 8))))
+
+    frame, corrupted, cut = corrupt_frame(frame, rng, crc_errors, truncated)
+    if corrupted:
+      stats.crc_errors += 1
+    if cut:
+      stats.truncated += 1
+    else:
+      stats.frames[message_type] += 1
+
+    out += frame
+
+    if garbage and rng.random() < garbage:
+      junk = garbage_bytes(rng)
+      out += junk
+      stats.garbage_bytes += len(junk)
+
+  return bytes(out), stats
@@ -0,0 +1,50 @@
+import unittest
+
+from serial_reader import Framer
+from synthetic import generate_stream, user_frame, state_frame, staterq_frame
+
+#
+# Run from the server directory: python3 -m unittest test_serial_reader
+
+# A user frame whose CRC ends in 0x00, so the frame without its last byte also passes the CRC
+def user_frame_with_zero_crc():
+  for i in range(1 << 16):
+    frame = user_frame(i.to_bytes(2, 'big'))
+    if frame[-1] == 0:
+      return frame
+  raise AssertionError('no user frame with a CRC ending in 0x00')
+
+def feed_in_pieces(data, size):
+  framer = Framer()
+  frames = []
+  for i in range(0, len(data), size):
+    frames += framer.feed(data[i:i + size])
+  return framer, frames
+
+class FramerTest(unittest.TestCase):
+  def test_user_frame_with_zero_crc_byte_at_a_time(self):
+    frame = user_frame_with_zero_crc()
+    data = staterq_frame(1) + frame + state_frame(1, 2, 3, 4, 5)
+    framer, frames = feed_in_pieces(data, 1)
+    self.assertEqual(frames, [staterq_frame(1), frame, state_frame(1, 2, 3, 4, 5)])
+    self.assertEqual(framer.garbage, 0)
+
+  def test_piece_size_does_not_change_the_frames(self):
+    data, _ = generate_stream(5000, boats=3, seed=7)
+    data += b''.join(user_frame_with_zero_crc() for _ in range(3))
+    _, whole = feed_in_pieces(data, len(data))
+    for size in (1, 7, 128):
+      _, frames = feed_in_pieces(data, size)
+      self.assertEqual(frames, whole, 'fed %d bytes at a time' % size)
+
+  def test_damaged_length_byte_does_not_hold_back_later_frames(self):
+    damaged = bytearray(user_frame(b'hello'))
+    damaged[3] = 0xF0
+    states = [state_frame(i, 0, 0, 0, 0) for i in range(5)]
+    framer = Framer()
+    frames = framer.feed(bytes(damaged) + b''.join(states))
+    self.assertEqual(frames[-5:], states)
+    self.assertEqual(framer.pending(), 0)
+
+if __name__ == '__main__':
+  unittest.main()
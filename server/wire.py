@@ -0,0 +1,74 @@
+import json
+from struct import Struct
+
+from packet_parser import get_fields
+
+#
+# Encodings of serial messages sent to the browser.
+#
+# Every client gets JSON unless it asks for the binary format with a `set_format`
+# event. A binary batch is a single Socket.IO binary attachment made of records:
+#   _id (uint32), source (uint8), node (uint8, NO_NODE if unknown), msg type (uint8),
+#   flags (uint8), raw frame length (uint16), raw frame bytes
+# All header values are little-endian. The browser decodes the fields from the raw frame.
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+FORMATS = (FORMAT_JSON, FORMAT_BINARY)
+
+BINARY_HEADER = Struct('<IBBBBH')
+FLAG_VALID = 0x01
+NO_NODE = 0xff
+
+#
+# Converts a queued message into its JSON shape, hex-encoding the raw frame.
+# The decoded values are only turned into a dict of fields here.
+def to_json(message):
+  if message['type'] != 'serial':
+    return message
+
+  return {
+    '_id': message['_id'],
+    'type': 'serial',
+    'msg': message['msg'],
+    'source': message.get('source', 0),
+    'node': message.get('node'),
+    'raw_data': message['raw'].hex(),
+    'parsed': dict(zip(get_fields(message['msg']), message['values'])),
+    'valid': message['valid']
+  }
+
+#
+# Packs a list of queued serial messages into one binary batch.
+def encode_binary(messages):
+  out = bytearray()
+  for message in messages:
+    raw = message['raw']
+    flags = FLAG_VALID if message['valid'] else 0
+    node = message.get('node')
+    if node is None:
+      node = NO_NODE
+    out += BINARY_HEADER.pack(message['_id'] & 0xffffffff, message.get('source', 0), node & 0xff,
+                              message['msg'], flags, len(raw))
+    out += raw
+  return bytes(out)
+
+#
+# Unpacks a binary batch into (_id, source, node, msg type, valid, raw frame) tuples.
+# node is None when unknown.
+def decode_binary(data):
+  messages = []
+  offset = 0
+  while offset + BINARY_HEADER.size <= len(data):
+    message_id, source, node, message_type, flags, length = BINARY_HEADER.unpack_from(data, offset)
+    offset += BINARY_HEADER.size
+    raw = bytes(data[offset:offset + length])
+    offset += length
+    messages.append((message_id, source, None if node == NO_NODE else node, message_type, bool(flags & FLAG_VALID), raw))
+  return messages
+
+#
+# Size in bytes of a message in each format, used to compare the encodings.
+def encoded_size(message, fmt):
+  if fmt == FORMAT_BINARY:
+    return BINARY_HEADER.size + len(message['raw'])
+  return len(json.dumps(to_json(message), separators=(',', ':')))